@@ -0,0 +1,52 @@
+import pandas as pd
+import folium
+from fsq_aggregate import parallel_aggregate
+from fsq_categories import CategoryDictionary, category_lookup
+from fsq_mirror import mirror_release
+
+# Foursquare release to analyse (None picks the latest release on S3)
+release_date = "2024-11-19"
+
+# Step 1: Make the release available in the local mirror
+release_parts = mirror_release(release_date)
+places_files = release_parts["places"]
+categories_files = release_parts["categories"]
+
+# Step 2: Load the categories; places are streamed in batches below
+categories = pd.read_parquet(categories_files, engine="pyarrow", columns=["category_id", "category_name"])
+
+# Step 3: Filter Categories dataset for 'beer'-related categories
+print("Filtering Categories dataset...")
+beer_categories = categories[categories['category_name'].str.contains('beer', case=False, na=False)]
+beer_category_ids = set(beer_categories['category_id'])
+
+# Step 4: Count and locate beer places per (country, category) in one pass over the places
+category_dictionary = CategoryDictionary(categories)
+beer_lookup = category_lookup(category_dictionary, beer_category_ids)
+beer_counts = parallel_aggregate(places_files, category_dictionary, beer_lookup)
+
+# Step 5: Analyze highest density categories per country, with their coordinate statistics
+print("Analyzing data...")
+beer_coordinates = beer_counts.category_coordinates()
+highest_density = beer_coordinates.loc[beer_coordinates.groupby('country')['poi_count'].idxmax()]
+highest_density = highest_density.dropna(subset=['centroid_latitude', 'centroid_longitude'])
+print(f"Highest density beer category per country:\n{highest_density}")
+
+# Step 6: Create the map; markers are placed at the spherical centroid, which stays
+# correct for countries that straddle the antimeridian (a plain mean does not)
+print("Creating map...")
+map_center = [20, 0]  # Global centering
+beer_map = folium.Map(location=map_center, zoom_start=2)
+
+for row in highest_density.itertuples(index=False):
+    folium.Marker(
+        location=[row.centroid_latitude, row.centroid_longitude],
+        popup=(f"Country: {row.country}<br>Category: {row.category_name}<br>POI Count: {row.poi_count}"
+               f"<br>Extent: {row.south:.2f}, {row.west:.2f} to {row.north:.2f}, {row.east:.2f}"),
+        tooltip=f"{row.country} - {row.category_name}"
+    ).add_to(beer_map)
+
+# Save and display the map
+map_file = "beer_density_map.html"
+beer_map.save(map_file)
+print(f"Map saved to {map_file}. Open it in a browser to view.")
@@ -0,0 +1,103 @@
+import pandas as pd
+import folium
+import numpy as np
+import jenkspy
+from fsq_categories import CategoryDictionary, category_lookup
+from fsq_countries import enrich_countries, load_country_reference
+from fsq_mirror import mirror_release
+from fsq_spatial import country_index, spatial_aggregate
+from fsq_world import load_world, region_areas
+
+# Foursquare release to analyse (None picks the latest release on S3)
+release_date = "2024-11-19"
+
+# Geospatial data for country boundaries (GeoJSON), kept in the local GeoParquet store after the first run
+world_geojson = "https://raw.githubusercontent.com/johan/world.geo.json/master/countries.geo.json"
+
+# Country of the beer places from their coordinates: "verify" only reports disagreements with the
+# country column, "fill" assigns places without a country, "replace" lets the boundaries decide
+country_mode = "fill"
+
+# Step 1: Make the release available in the local mirror
+release_parts = mirror_release(release_date)
+places_files = release_parts["places"]
+categories_files = release_parts["categories"]
+
+# Step 2: Load the categories; places are streamed in batches below
+categories = pd.read_parquet(categories_files, engine="pyarrow", columns=["category_id", "category_name"])
+
+# Country reference table (alpha-2, alpha-3, numeric, name, area), bundled with the scripts
+country_reference = load_country_reference()
+print(f"Loaded country reference version {country_reference.attrs['version']} with {len(country_reference)} countries.")
+
+# Step 3: Filter for 'beer'-related categories
+beer_categories = categories[categories['category_name'].str.contains('beer', case=False, na=False)]
+beer_category_ids = set(beer_categories['category_id'])
+print(f"Beer categories: {beer_category_ids}")
+
+# Aggregate the places files in parallel, with the country of every beer place checked against the boundaries
+category_dictionary = CategoryDictionary(categories)
+beer_lookup = category_lookup(category_dictionary, beer_category_ids)
+countries_index = country_index(world_geojson)
+beer_counts, country_check = spatial_aggregate(places_files, category_dictionary, beer_lookup, countries_index,
+                                               country_mode)
+country_check.report()
+
+country_poi_counts = beer_counts.country_poi_counts()
+if country_poi_counts.empty:
+    raise ValueError("No beer-related POIs found after filtering.")
+
+# Highest density category per country
+beer_density = beer_counts.category_density()
+highest_density = beer_density.loc[beer_density.groupby('country')['poi_count'].idxmax()]
+print(f"Highest density beer category per country:\n{highest_density}")
+
+# Step 4: Calculate POI density
+# Areas computed from the boundaries in an equal-area projection (cached), the reference table for countries without one
+country_poi_counts = enrich_countries(country_poi_counts, attributes=('alpha_3', 'name', 'area_km2'))
+boundary_areas = region_areas(world_geojson).rename(columns={'id': 'alpha_3', 'area_km2': 'boundary_area'})
+country_poi_counts = country_poi_counts.merge(boundary_areas, on='alpha_3', how='left')
+country_poi_counts['surface_area'] = country_poi_counts['boundary_area'].fillna(country_poi_counts['area_km2'])
+country_poi_counts = country_poi_counts.dropna(subset=['surface_area'])
+country_poi_counts['poi_density'] = country_poi_counts['poi_count'] / country_poi_counts['surface_area']
+country_poi_counts['poi_density_scaled'] = country_poi_counts['poi_density'] * 1e6  # Scale density values
+print(f"Calculated POI density:\n{country_poi_counts}")
+
+# Step 5: Classify densities using natural breaks or fallback
+poi_densities = country_poi_counts['poi_density_scaled'].dropna().values
+
+try:
+    if len(np.unique(poi_densities)) >= 5:
+        jenks_breaks = jenkspy.jenks_breaks(poi_densities, n_classes=5)
+    else:
+        raise ValueError("Not enough unique values for Jenks Natural Breaks.")
+except Exception as e:
+    print(f"Error computing Jenks Natural Breaks: {e}")
+    print("Falling back to equal intervals.")
+    jenks_breaks = np.linspace(poi_densities.min(), poi_densities.max(), num=6)
+
+print(f"Jenks breaks: {jenks_breaks}")
+country_poi_counts['density_class'] = pd.cut(country_poi_counts['poi_density_scaled'], bins=jenks_breaks, labels=False)
+
+# Step 6: Load the world boundaries for mapping from the local store
+world = load_world(world_geojson)
+world = world.merge(country_poi_counts, left_on="id", right_on="alpha_3", how="left")
+
+# Step 7: Create the map
+map_center = [20, 0]
+range_map = folium.Map(location=map_center, zoom_start=2)
+folium.Choropleth(
+    geo_data=world,
+    name='choropleth',
+    data=country_poi_counts,
+    columns=['alpha_3', 'density_class'],
+    key_on='feature.properties.id',
+    fill_color='YlGn',
+    fill_opacity=0.7,
+    line_opacity=0.2,
+    legend_name='POI Density per Country'
+).add_to(range_map)
+
+range_map_file = "beer_density_range_map.html"
+range_map.save(range_map_file)
+print(f"Range map saved to {range_map_file}.")
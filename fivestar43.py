@@ -0,0 +1,58 @@
+import pandas as pd
+import folium
+from fsq_categories import CategoryDictionary
+from fsq_mirror import mirror_release
+from fsq_regions import open_region_set, region_counts, region_density
+from fsq_themes import ThemeSet, themes
+
+# Foursquare release to analyse (None picks the latest release on S3)
+release_date = "2024-11-19"
+
+# Regions to aggregate over: any GeoJSON or GeoParquet file (metro areas, sales territories, custom polygons)
+# with one or more features per region, and the column that identifies the region of a feature
+region_source = "https://raw.githubusercontent.com/johan/world.geo.json/master/countries.geo.json"
+region_id_column = "id"
+
+# Step 1: Make the release available in the local mirror
+release_parts = mirror_release(release_date)
+places_files = release_parts["places"]
+categories_files = release_parts["categories"]
+
+# Step 2: Load the categories and compile every theme (beer, wine, coffee, cocktail, ...) once against them
+categories = pd.read_parquet(categories_files, engine="pyarrow", columns=["category_id", "category_name"])
+category_dictionary = CategoryDictionary(categories)
+theme_set = ThemeSet(category_dictionary, themes)
+
+# Step 3: Load the region set; its spatial index is built on the first run and loaded afterwards
+region_set = open_region_set(region_source, region_id_column)
+
+# Step 4: Assign the places of every theme to the regions in one pass over the places files
+theme_region_counts = region_counts(places_files, theme_set, region_set)
+print(f"POIs per theme:\n{theme_region_counts.groupby('theme')['poi_count'].sum()}")
+
+# Step 5 and 6 for every theme: density per region area, Jenks classes and map
+map_center = [20, 0]
+
+for theme in theme_set.names:
+    region_poi_density = region_density(theme_region_counts, region_set, theme)
+    if region_poi_density['poi_count'].sum() == 0:
+        print(f"No {theme}-related POIs found in the regions, skipping map.")
+        continue
+    print(f"Calculated {theme} POI density:\n{region_poi_density}")
+
+    range_map = folium.Map(location=map_center, zoom_start=2)
+    folium.Choropleth(
+        geo_data=region_set.boundaries,
+        name='choropleth',
+        data=region_poi_density,
+        columns=[region_id_column, 'density_class'],
+        key_on=f'feature.properties.{region_id_column}',
+        fill_color='YlGn',
+        fill_opacity=0.7,
+        line_opacity=0.2,
+        legend_name=f'{theme.capitalize()} POI Density per Region'
+    ).add_to(range_map)
+
+    range_map_file = f"{theme}_region_density_map.html"
+    range_map.save(range_map_file)
+    print(f"Range map saved to {range_map_file}.")
@@ -0,0 +1,356 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from fsq_categories import has_any_category, row_index
+from fsq_remote import places_columns
+
+# Bump when the aggregation changes, so cached aggregates are not reused
+aggregator_version = 1
+
+# Rows decoded at a time when streaming a places file; sets peak memory
+batch_size = 250_000
+
+# Row groups per shard in parallel_aggregate, and worker processes (None: all cores)
+shard_row_groups = 1
+max_processes = None
+
+
+def iter_place_batches(paths, columns=places_columns, batch_rows=None, row_groups=None):
+    """
+    Yield record batches of the given columns from local Parquet files, never
+    the full table. row_groups limits every file to those row groups.
+    """
+    for path in [paths] if isinstance(paths, str) else paths:
+        parquet_file = pq.ParquetFile(path)
+        yield from parquet_file.iter_batches(batch_size=batch_rows or batch_size, columns=columns,
+                                             row_groups=row_groups)
+
+
+def lookup_columns(lookup):
+    """
+    Column of every category code in a matrix that only has the categories of
+    the lookup table, -1 for the other codes (and for code -1, the last entry).
+    """
+    columns = np.full(len(lookup), -1, dtype=np.int32)
+    columns[np.flatnonzero(lookup)] = np.arange(np.count_nonzero(lookup), dtype=np.int32)
+    return columns
+
+
+def pair_index(country_codes, offsets, codes, columns, column_count):
+    """
+    The (place, category) pairs whose category has a column and whose place
+    has a country (code >= 0): the place row of every pair and its flat index
+    country * column_count + column into a country x column matrix.
+    """
+    rows = row_index(offsets)
+    value_columns = columns[codes]
+    keep = (value_columns >= 0) & (country_codes[rows] >= 0)
+    rows = rows[keep]
+    return rows, country_codes[rows].astype(np.int64) * column_count + value_columns[keep]
+
+
+def count_matrix(country_codes, offsets, codes, lookup, country_count):
+    """
+    Dense country x category count matrix of the (place, category) pairs whose
+    category is in the lookup table, in one bincount over combined indices.
+    country_codes holds one code per place (-1 for no country); offsets and
+    codes are the CSR category codes. Nothing is exploded, merged or grouped.
+    """
+    category_count = len(lookup) - 1  # The last lookup entry is for code -1
+    columns = np.where(lookup, np.arange(len(lookup), dtype=np.int32), np.int32(-1))
+    _, keys = pair_index(country_codes, offsets, codes, columns, category_count)
+    counts = np.bincount(keys, minlength=country_count * category_count)
+    return counts.reshape(country_count, category_count)
+
+
+class GroupedCoordinates:
+    """
+    Coordinate statistics of points in numbered groups, built in one pass with
+    bincount and ufunc.at: count, mean latitude and longitude, the spherical
+    centroid (mean of the unit vectors, correct across the antimeridian) and
+    the bounding box. Longitudes are also tracked on 0..360, so a group that
+    straddles the antimeridian gets the narrow box with west > east.
+    """
+
+    sums = ['count', 'latitude_sum', 'longitude_sum', 'x_sum', 'y_sum', 'z_sum']
+    minimums = ['south', 'west', 'west_360']
+    maximums = ['north', 'east', 'east_360']
+
+    def __init__(self, group_count=0):
+        for name in self.sums:
+            setattr(self, name, np.zeros(group_count, dtype=np.int64 if name == 'count' else np.float64))
+        for name in self.minimums:
+            setattr(self, name, np.full(group_count, np.inf))
+        for name in self.maximums:
+            setattr(self, name, np.full(group_count, -np.inf))
+
+    def __len__(self):
+        return len(self.count)
+
+    def grow(self, group_count):
+        """Extend to group_count groups; new groups are empty."""
+        extra = group_count - len(self)
+        if extra > 0:
+            empty = GroupedCoordinates(extra)
+            for name in self.sums + self.minimums + self.maximums:
+                setattr(self, name, np.concatenate([getattr(self, name), getattr(empty, name)]))
+
+    def add(self, groups, latitude, longitude):
+        """Fold points (latitude and longitude in degrees) with their group numbers in."""
+        self.grow(int(groups.max()) + 1 if len(groups) else 0)
+        n = len(self)
+        phi, lam = np.radians(latitude), np.radians(longitude)
+        longitude_360 = np.mod(longitude, 360.0)
+        self.count += np.bincount(groups, minlength=n)
+        for name, values in [('latitude_sum', latitude), ('longitude_sum', longitude),
+                             ('x_sum', np.cos(phi) * np.cos(lam)), ('y_sum', np.cos(phi) * np.sin(lam)),
+                             ('z_sum', np.sin(phi))]:
+            getattr(self, name)[:] += np.bincount(groups, weights=values, minlength=n)
+        for name, values in [('south', latitude), ('west', longitude), ('west_360', longitude_360)]:
+            np.minimum.at(getattr(self, name), groups, values)
+        for name, values in [('north', latitude), ('east', longitude), ('east_360', longitude_360)]:
+            np.maximum.at(getattr(self, name), groups, values)
+        return self
+
+    def merge(self, other, index=None):
+        """Fold another GroupedCoordinates in; index maps its groups to ours (default: the same numbers)."""
+        index = np.arange(len(other)) if index is None else index
+        self.grow(int(index.max()) + 1 if len(index) else 0)
+        for name in self.sums:
+            getattr(self, name)[index] += getattr(other, name)
+        for name in self.minimums:
+            np.minimum.at(getattr(self, name), index, getattr(other, name))
+        for name in self.maximums:
+            np.maximum.at(getattr(self, name), index, getattr(other, name))
+        return self
+
+    def table(self, groups):
+        """DataFrame of the statistics of the given groups, one row per group."""
+        count = self.count[groups]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x, y, z = (getattr(self, name)[groups] / count for name in ['x_sum', 'y_sum', 'z_sum'])
+            stats = pd.DataFrame({
+                'point_count': count,
+                'mean_latitude': self.latitude_sum[groups] / count,
+                'mean_longitude': self.longitude_sum[groups] / count,
+                'centroid_latitude': np.degrees(np.arctan2(z, np.hypot(x, y))),
+                'centroid_longitude': np.degrees(np.arctan2(y, x)),
+                'south': self.south[groups],
+                'north': self.north[groups],
+            })
+        west, east = self.west[groups], self.east[groups]
+        west_360, east_360 = self.west_360[groups], self.east_360[groups]
+        # The box on 0..360 is narrower when the points straddle the antimeridian
+        wrapped = (east_360 - west_360) < (east - west)
+        stats['west'] = np.where(wrapped, (west_360 + 180) % 360 - 180, west)
+        stats['east'] = np.where(wrapped, (east_360 + 180) % 360 - 180, east)
+        empty = count == 0
+        stats.loc[empty, ['centroid_latitude', 'centroid_longitude', 'south', 'north', 'west', 'east']] = np.nan
+        return stats[['point_count', 'mean_latitude', 'mean_longitude', 'centroid_latitude',
+                      'centroid_longitude', 'south', 'west', 'north', 'east']]
+
+
+class CountryIndex:
+    """Stable integer codes for country strings, growing as new countries are seen."""
+
+    def __init__(self):
+        self.names = []
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, names):
+        """Codes of a list of country names, adding the new ones."""
+        for name in names:
+            if name not in self.codes:
+                self.codes[name] = len(self.names)
+                self.names.append(name)
+        return np.array([self.codes[name] for name in names], dtype=np.int32)
+
+    def encode(self, column):
+        """Codes of an Arrow country column (-1 for null)."""
+        encoded = pc.dictionary_encode(column)
+        if hasattr(encoded, 'combine_chunks'):
+            encoded = encoded.combine_chunks()
+        mapping = np.append(self.add(encoded.dictionary.to_pylist()), np.int32(-1))
+        return mapping[encoded.indices.fill_null(-1).to_numpy(zero_copy_only=False)]
+
+
+class DensityAccumulator:
+    """
+    Running counts of the places that have a category in a lookup table:
+    country -> poi_count, and (country, category) -> count, the latter
+    counting a place once for every matching category it has. The
+    (country, category) counts are a dense matrix with one column per
+    category of the lookup table. Coordinate statistics of every
+    (country, category) are kept alongside in a GroupedCoordinates, over the
+    places that have both coordinates. Accumulators of separate shards merge
+    into one.
+    """
+
+    def __init__(self, dictionary, lookup):
+        self.dictionary = dictionary
+        self.lookup = lookup
+        self.columns = lookup_columns(lookup)
+        self.column_codes = np.flatnonzero(lookup[:-1])
+        self.countries = CountryIndex()
+        self.country_totals = np.zeros(0, dtype=np.int64)
+        self.pair_counts = np.zeros((0, len(self.column_codes)), dtype=np.int64)
+        self.coordinates = GroupedCoordinates()
+        self.rows = 0
+
+    def add(self, batch):
+        """Parse, filter and fold one batch (Arrow table or record batch) into the counts."""
+        offsets, codes = self.dictionary.encode_lists(batch.column('fsq_category_ids'))
+        country_codes = self.countries.encode(batch.column('country'))
+        latitude = batch.column('latitude').to_numpy(zero_copy_only=False)
+        longitude = batch.column('longitude').to_numpy(zero_copy_only=False)
+        return self.add_codes(country_codes, offsets, codes, latitude, longitude)
+
+    def add_codes(self, country_codes, offsets, codes, latitude, longitude):
+        """
+        Fold places that are already encoded in: country codes of self.countries,
+        CSR codes of self.dictionary and the coordinates.
+        """
+        self.rows += len(country_codes)
+        self.grow()
+
+        matches = has_any_category(offsets, codes, self.lookup) & (country_codes >= 0)
+        self.country_totals += np.bincount(country_codes[matches], minlength=len(self.countries))
+        rows, keys = pair_index(country_codes, offsets, codes, self.columns, len(self.column_codes))
+        self.pair_counts += np.bincount(keys, minlength=self.pair_counts.size).reshape(self.pair_counts.shape)
+
+        latitude = np.asarray(latitude)[rows].astype(np.float64)
+        longitude = np.asarray(longitude)[rows].astype(np.float64)
+        located = ~(np.isnan(latitude) | np.isnan(longitude))
+        self.coordinates.add(keys[located], latitude[located], longitude[located])
+        return self
+
+    def merge(self, other):
+        """Add the counts of another accumulator (e.g. of another shard) to this one."""
+        index = self.countries.add(other.countries.names)
+        self.grow()
+        self.rows += other.rows
+        self.country_totals[index] += other.country_totals
+        self.pair_counts[index] += other.pair_counts
+        column_count = len(self.column_codes)
+        groups = (index[:, None].astype(np.int64) * column_count + np.arange(column_count)).ravel()
+        self.coordinates.merge(other.coordinates, groups)
+        return self
+
+    def grow(self):
+        """Add zero rows for countries seen for the first time."""
+        extra = len(self.countries) - len(self.country_totals)
+        if extra:
+            self.country_totals = np.concatenate([self.country_totals, np.zeros(extra, dtype=np.int64)])
+            self.pair_counts = np.vstack([self.pair_counts, np.zeros((extra, len(self.column_codes)), dtype=np.int64)])
+        self.coordinates.grow(self.pair_counts.size)
+
+    def country_poi_counts(self):
+        """DataFrame (country, poi_count), like beer_places.groupby('country').size()."""
+        counts = pd.DataFrame({'country': self.countries.names, 'poi_count': self.country_totals})
+        return counts[counts['poi_count'] > 0].sort_values('country', ignore_index=True)
+
+    def category_density(self):
+        """DataFrame (country, category_name, poi_count), like the beer_density frame of fivestar9.py."""
+        country_codes, columns = np.nonzero(self.pair_counts)
+        density = pd.DataFrame({
+            'country': np.array(self.countries.names, dtype=object)[country_codes],
+            'category_name': self.dictionary.category_names(self.column_codes[columns]),
+            'poi_count': self.pair_counts[country_codes, columns],
+        })
+        return density.sort_values(['country', 'category_name'], ignore_index=True)
+
+    def category_id_counts(self):
+        """DataFrame (country, category_id, poi_count): category_density keyed by the stable category id."""
+        country_codes, columns = np.nonzero(self.pair_counts)
+        counts = pd.DataFrame({
+            'country': np.array(self.countries.names, dtype=object)[country_codes],
+            'category_id': self.dictionary.decode(self.column_codes[columns]),
+            'poi_count': self.pair_counts[country_codes, columns],
+        })
+        return counts.sort_values(['country', 'category_id'], ignore_index=True)
+
+    def category_coordinates(self):
+        """
+        category_density with the coordinate statistics of every row: mean and
+        spherical centroid latitude and longitude, and the bounding box.
+        """
+        country_codes, columns = np.nonzero(self.pair_counts)
+        stats = self.coordinates.table(country_codes.astype(np.int64) * len(self.column_codes) + columns)
+        stats.insert(0, 'country', np.array(self.countries.names, dtype=object)[country_codes])
+        stats.insert(1, 'category_name', self.dictionary.category_names(self.column_codes[columns]))
+        stats.insert(2, 'poi_count', self.pair_counts[country_codes, columns])
+        return stats.sort_values(['country', 'category_name'], ignore_index=True)
+
+
+def stream_aggregate(paths, dictionary, lookup, batch_rows=None):
+    """Fold every batch of the places files into a DensityAccumulator."""
+    accumulator = DensityAccumulator(dictionary, lookup)
+    for batch in iter_place_batches(paths, batch_rows=batch_rows):
+        accumulator.add(batch)
+    print(f"Aggregated {accumulator.rows} places in batches of {batch_rows or batch_size} rows")
+    return accumulator
+
+
+def plan_shards(paths, row_groups_per_shard=None):
+    """Split local Parquet files into (path, row groups) shards of a few row groups each."""
+    row_groups_per_shard = row_groups_per_shard or shard_row_groups
+    shards = []
+    for path in [paths] if isinstance(paths, str) else paths:
+        num_row_groups = pq.ParquetFile(path).metadata.num_row_groups
+        for start in range(0, num_row_groups, row_groups_per_shard):
+            shards.append((path, list(range(start, min(start + row_groups_per_shard, num_row_groups)))))
+    return shards
+
+
+def aggregate_shard(shard, dictionary, lookup, batch_rows=None):
+    """Worker: a DensityAccumulator over the row groups of one shard."""
+    path, row_groups = shard
+    accumulator = DensityAccumulator(dictionary, lookup)
+    for batch in iter_place_batches(path, batch_rows=batch_rows, row_groups=row_groups):
+        accumulator.add(batch)
+    return accumulator
+
+
+def process_context():
+    """
+    Fork where the platform has it: the fivestar scripts are plain top-level
+    code, which spawned workers would run again on import.
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def parallel_aggregate(paths, dictionary, lookup, max_workers=None, row_groups_per_shard=None, batch_rows=None):
+    """
+    stream_aggregate over a process pool: every worker aggregates one shard
+    (a file's row group range) and the partial accumulators are merged in
+    shard order, so the result does not depend on which worker finishes first.
+    """
+    max_workers = max_workers or max_processes or os.cpu_count()
+    shards = plan_shards(paths, row_groups_per_shard)
+    start = time.perf_counter()
+    accumulator = DensityAccumulator(dictionary, lookup)
+    if max_workers == 1:
+        for shard in shards:
+            accumulator.merge(aggregate_shard(shard, dictionary, lookup, batch_rows))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=process_context()) as executor:
+            partials = executor.map(aggregate_shard, shards, [dictionary] * len(shards),
+                                    [lookup] * len(shards), [batch_rows] * len(shards))
+            for partial in partials:
+                accumulator.merge(partial)
+    elapsed = time.perf_counter() - start
+    print(f"Aggregated {accumulator.rows} places in {len(shards)} shards with {max_workers} processes "
+          f"in {elapsed:.1f}s ({accumulator.rows / max(elapsed, 1e-9) / 1e6:.1f}M rows/s)")
+    return accumulator
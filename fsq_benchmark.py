@@ -0,0 +1,174 @@
+"""
+Benchmarks of the processing stages on synthetic data (see fsq_synthetic.py).
+
+    python3 fsq_benchmark.py --rows 1e6
+"""
+import argparse
+import glob
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from fsq_aggregate import DensityAccumulator, parallel_aggregate, stream_aggregate
+from fsq_categories import (
+    CategoryDictionary, category_lookup, has_any_category, parse_fsq_category_ids,
+)
+from fsq_synthetic import generate_release, generate_world, make_categories, make_places
+
+
+def timed(description, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    print(f"  {description:<40} {elapsed:8.3f}s")
+    return result, elapsed
+
+
+def legacy_parse_fsq_category_ids(fsq_category_ids):
+    """The per-row parser of fivestar13.py - fivestar24.py."""
+    if str(fsq_category_ids).strip() == "":
+        return np.array([])
+    return np.array(str(fsq_category_ids).strip("[]").replace("'", "").split())
+
+
+def benchmark_parse(places):
+    print("Parsing fsq_category_ids")
+    series = places['fsq_category_ids'].to_pandas()
+    legacy, legacy_time = timed("legacy .apply", series.apply, legacy_parse_fsq_category_ids)
+    (offsets, values), fast_time = timed("vectorized on list<string>", parse_fsq_category_ids,
+                                         places['fsq_category_ids'])
+    strings = series.astype(str)
+    (string_offsets, _), _ = timed("vectorized on legacy strings", parse_fsq_category_ids, strings)
+    assert np.array_equal(np.diff(offsets), legacy.map(len).to_numpy())
+    assert np.array_equal(offsets, string_offsets)
+    print(f"  speedup {legacy_time / fast_time:.0f}x")
+
+
+def benchmark_encode(places, categories):
+    print("Encoding fsq_category_ids as integer codes (CSR)")
+    dictionary, _ = timed("build dictionary", CategoryDictionary, categories)
+    (offsets, codes), _ = timed("parse + encode", dictionary.encode_lists, places['fsq_category_ids'])
+    pandas_bytes = places['fsq_category_ids'].to_pandas().memory_usage(deep=True)
+    arrow_bytes = places['fsq_category_ids'].nbytes
+    csr_bytes = offsets.nbytes + codes.nbytes
+    print(f"  pandas object column   {pandas_bytes / 1e6:10.1f} MB")
+    print(f"  Arrow list<string>     {arrow_bytes / 1e6:10.1f} MB")
+    print(f"  CSR {offsets.dtype} + {codes.dtype}    {csr_bytes / 1e6:10.1f} MB "
+          f"({pandas_bytes / csr_bytes:.0f}x smaller than pandas, {arrow_bytes / csr_bytes:.0f}x than Arrow)")
+
+
+def benchmark_filter(places, categories, keyword="beer"):
+    print(f"Filtering places with a '{keyword}' category")
+    names = categories['category_name'].to_pandas()
+    selected = set(categories['category_id'].to_pandas()[names.str.contains(keyword, case=False, na=False)])
+    series = places['fsq_category_ids'].to_pandas()
+    legacy, legacy_time = timed("legacy any(...) lambda", series.apply,
+                                lambda ids: any(cat_id in selected for cat_id in ids))
+
+    dictionary = CategoryDictionary(categories)
+    offsets, codes = dictionary.encode_lists(places['fsq_category_ids'])
+    lookup = category_lookup(dictionary, selected)
+    mask, fast_time = timed("lookup table on codes", has_any_category, offsets, codes, lookup)
+    assert np.array_equal(mask, legacy.to_numpy())
+    print(f"  {mask.sum()} matching places, speedup {legacy_time / fast_time:.0f}x "
+          f"(excluding the one-off parse + encode)")
+
+
+def benchmark_count(places, categories, keyword="beer"):
+    print(f"Counting (country, category) pairs of '{keyword}' places")
+    names = categories['category_name'].to_pandas()
+    selected_categories = categories.to_pandas()[names.str.contains(keyword, case=False, na=False)]
+    selected = set(selected_categories['category_id'])
+
+    def legacy_count():
+        # The explode / merge / groupby of fivestar9.py
+        frame = places.select(['fsq_category_ids', 'country']).to_pandas()
+        frame = frame[frame['fsq_category_ids'].apply(lambda ids: any(cat_id in selected for cat_id in ids))]
+        frame = frame.explode('fsq_category_ids')
+        frame = frame[frame['fsq_category_ids'].isin(selected)]
+        frame = frame.merge(selected_categories, left_on="fsq_category_ids", right_on="category_id")
+        return frame.groupby(['country', 'category_name']).size().reset_index(name='poi_count')
+
+    def kernel_count():
+        return DensityAccumulator(dictionary, lookup).add(places).category_density()
+
+    dictionary = CategoryDictionary(categories)
+    lookup = category_lookup(dictionary, selected)
+    legacy, legacy_time = timed("explode + merge + groupby", legacy_count)
+    fast, fast_time = timed("bincount count matrix (incl. encode)", kernel_count)
+    assert legacy.equals(fast)
+    print(f"  {len(fast)} (country, category) rows, speedup {legacy_time / fast_time:.0f}x")
+
+
+def benchmark_parallel(rows, workers, keyword="beer"):
+    print(f"Aggregating '{keyword}' places of {rows} places on disk with a process pool")
+    with tempfile.TemporaryDirectory() as out_dir:
+        # Four row groups (shards) per process at the highest process count
+        release_dir = generate_release(out_dir, rows, row_group_size=max(rows // (4 * max(workers)), 1))
+        paths = sorted(glob.glob(os.path.join(release_dir, "places", "parquet", "*.parquet")))
+        categories = make_categories(42)
+        names = categories['category_name'].to_pandas()
+        selected = set(categories['category_id'].to_pandas()[names.str.contains(keyword, case=False, na=False)])
+        dictionary = CategoryDictionary(categories)
+        lookup = category_lookup(dictionary, selected)
+
+        serial, serial_time = timed("serial stream_aggregate", stream_aggregate, paths, dictionary, lookup)
+        for count in workers:
+            parallel, elapsed = timed(f"{count} processes", parallel_aggregate, paths, dictionary, lookup, count)
+            assert parallel.category_density().equals(serial.category_density())
+            assert parallel.country_poi_counts().equals(serial.country_poi_counts())
+            print(f"  {count} processes: {serial_time / elapsed:.1f}x serial, "
+                  f"{serial_time / elapsed / count:.0%} parallel efficiency")
+
+
+def benchmark_assign(places):
+    import geopandas as gpd
+    import shapely
+
+    from fsq_spatial import RegionIndex
+
+    print("Assigning places to synthetic country polygons")
+    with tempfile.TemporaryDirectory() as out_dir:
+        world = gpd.read_file(generate_world(os.path.join(out_dir, "countries.geo.json")))
+    # Densify the straight Voronoi edges to about the vertex count of real boundaries
+    world['geometry'] = world.geometry.segmentize(0.05)
+    longitude = places.column('longitude').to_numpy(zero_copy_only=False)
+    latitude = places.column('latitude').to_numpy(zero_copy_only=False)
+    index, _ = timed("build RegionIndex", RegionIndex, world)
+    regions, elapsed = timed("grid + STRtree assign", index.assign, longitude, latitude)
+    print(f"  {len(regions) / elapsed * 60 / 1e6:.0f}M points per minute")
+
+    # A plain predicate query on the whole polygons, on a slice of the points
+    sample = slice(0, min(len(longitude), 100_000))
+    tree = shapely.STRtree(world.geometry.to_numpy())
+    points = shapely.points(longitude[sample], latitude[sample])
+    (point_rows, polygons), plain_time = timed("plain STRtree query (100k points)", tree.query, points, 'intersects')
+    plain = np.full(len(points), -1)
+    plain[point_rows[::-1]] = polygons[::-1]
+    assert (plain == regions[sample]).all()
+    print(f"  plain: {len(points) / plain_time * 60 / 1e6:.1f}M points per minute")
+
+
+def make_dataset(rows, seed=42):
+    categories = make_categories(seed)
+    places = make_places(np.random.default_rng(seed), seed, 0, rows, categories)
+    return places, categories
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the processing stages on synthetic data.")
+    parser.add_argument("--rows", type=float, default=1e6)
+    parser.add_argument("--workers", type=int, nargs="*", default=[1, 2, 4, 8, 16, 32],
+                        help="process counts for the parallel aggregation benchmark")
+    args = parser.parse_args()
+
+    places, categories = make_dataset(int(args.rows))
+    print(f"{places.num_rows} synthetic places")
+    benchmark_parse(places)
+    benchmark_encode(places, categories)
+    benchmark_filter(places, categories)
+    benchmark_count(places, categories)
+    benchmark_assign(places)
+    benchmark_parallel(int(args.rows), [count for count in args.workers if count <= os.cpu_count()] or [1])
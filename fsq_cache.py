@@ -0,0 +1,159 @@
+"""
+Local Parquet cache of aggregate tables (country_poi_counts, beer_density, ...).
+
+Entries live in <cache_dir>/<key>/<table>.parquet. The key is a hash of the
+release root and date, the category filter set and the parser and
+aggregator versions, so changing any of them misses the cache; map styling changes hit
+it and skip the places scan entirely.
+
+    python3 fsq_cache.py --stats
+    python3 fsq_cache.py --invalidate [--release 2024-11-19]
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from fsq_aggregate import aggregator_version
+from fsq_categories import parser_version
+from fsq_download import release_bucket
+from fsq_mirror import resolve_release
+
+cache_dir = "fsq_cache"
+
+
+def cache_key(release_date, category_ids, name="aggregates"):
+    """Hash of what the cached tables depend on."""
+    inputs = {
+        'name': name,
+        'root': release_bucket,
+        'release': release_date,
+        'category_ids': sorted(category_ids),
+        'parser_version': parser_version,
+        'aggregator_version': aggregator_version,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def entry_dir(key):
+    return os.path.join(cache_dir, key)
+
+
+def stats_path():
+    return os.path.join(cache_dir, "stats.json")
+
+
+def load_stats():
+    if not os.path.exists(stats_path()):
+        return {'hits': 0, 'misses': 0}
+    with open(stats_path()) as f:
+        return json.load(f)
+
+
+def record(result):
+    """Count a hit or miss in the cache statistics."""
+    stats = load_stats()
+    stats[result] += 1
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(stats_path() + ".tmp", 'w') as f:
+        json.dump(stats, f)
+    os.replace(stats_path() + ".tmp", stats_path())
+    return stats
+
+
+def hit_rate(stats=None):
+    stats = stats or load_stats()
+    lookups = stats['hits'] + stats['misses']
+    return stats['hits'] / lookups if lookups else 0.0
+
+
+def read_entry(key, tables):
+    """The cached tables of key as a dict, or None if any of them is missing."""
+    paths = {table: os.path.join(entry_dir(key), f"{table}.parquet") for table in tables}
+    if not all(os.path.exists(path) for path in paths.values()):
+        return None
+    return {table: pd.read_parquet(path) for table, path in paths.items()}
+
+
+def write_entry(key, results, release_date, category_ids):
+    """Write the tables of key next to a meta.json with the key inputs; the directory is swapped in whole."""
+    tmp_dir = entry_dir(key) + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for table, frame in results.items():
+        frame.to_parquet(os.path.join(tmp_dir, f"{table}.parquet"), index=False)
+    with open(os.path.join(tmp_dir, "meta.json"), 'w') as f:
+        json.dump({
+            'root': release_bucket,
+            'release': release_date,
+            'category_ids': sorted(category_ids),
+            'parser_version': parser_version,
+            'aggregator_version': aggregator_version,
+            'tables': list(results),
+        }, f, indent=2)
+    shutil.rmtree(entry_dir(key), ignore_errors=True)
+    os.replace(tmp_dir, entry_dir(key))
+
+
+def cached_aggregates(release_date, category_ids, tables, compute, name="aggregates"):
+    """
+    The aggregate tables for a release and category filter set: read from the
+    cache on a hit, else compute() (which returns a dict of table name ->
+    DataFrame) is run and its result stored. release_date=None is the newest
+    release on S3, resolved before keying.
+    """
+    release_date = resolve_release(release_date)
+    key = cache_key(release_date, category_ids, name)
+    results = read_entry(key, tables)
+    stats = record('hits' if results is not None else 'misses')
+    if results is not None:
+        print(f"Aggregate cache hit {key} for dt={release_date} (hit rate {hit_rate(stats):.0%})")
+        return results
+    print(f"Aggregate cache miss {key} for dt={release_date} (hit rate {hit_rate(stats):.0%})")
+    results = compute()
+    write_entry(key, {table: results[table] for table in tables}, release_date, category_ids)
+    return results
+
+
+def list_entries():
+    """(key, meta) of every cache entry."""
+    entries = []
+    if os.path.isdir(cache_dir):
+        for key in sorted(os.listdir(cache_dir)):
+            meta_file = os.path.join(entry_dir(key), "meta.json")
+            if os.path.exists(meta_file):
+                with open(meta_file) as f:
+                    entries.append((key, json.load(f)))
+    return entries
+
+
+def invalidate(release_date=None):
+    """Delete the cache entries of a release, or every entry; returns the number deleted."""
+    removed = 0
+    for key, meta in list_entries():
+        if release_date is None or meta['release'] == release_date:
+            shutil.rmtree(entry_dir(key))
+            removed += 1
+    print(f"Invalidated {removed} aggregate cache entries" + (f" of dt={release_date}" if release_date else ""))
+    return removed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or invalidate the aggregate cache.")
+    parser.add_argument("--invalidate", action="store_true", help="delete cache entries")
+    parser.add_argument("--release", help="only the entries of this release date")
+    parser.add_argument("--stats", action="store_true", help="show the entries and the hit rate")
+    args = parser.parse_args()
+    if args.invalidate:
+        invalidate(args.release)
+    if args.stats or not args.invalidate:
+        for key, meta in list_entries():
+            if args.release is None or meta['release'] == args.release:
+                print(f"{key}  dt={meta['release']}  {len(meta['category_ids'])} categories  "
+                      f"parser {meta['parser_version']}  aggregator {meta['aggregator_version']}  "
+                      f"{', '.join(meta['tables'])}")
+        stats = load_stats()
+        print(f"{stats['hits']} hits, {stats['misses']} misses, hit rate {hit_rate(stats):.0%}")
@@ -0,0 +1,110 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Bump when parsing or encoding changes, so cached results built on it are not reused
+parser_version = 1
+
+
+def parse_fsq_category_ids(column):
+    """
+    Vectorized parser for the fsq_category_ids column.
+
+    Accepts the Arrow list<string> column of the release, or the legacy string
+    form ("['4bf58dd8...' '4bf58dd8...']") that older exports contain, as an
+    Arrow array, chunked array or pandas Series. Returns (offsets, values):
+    offsets is an int64 numpy array of len(column) + 1 and values a flat Arrow
+    string array, so the ids of row i are values[offsets[i]:offsets[i + 1]].
+    Null and empty entries give empty rows. No per-row Python objects are made.
+    """
+    if not isinstance(column, (pa.Array, pa.ChunkedArray)):
+        column = pa.array(column, from_pandas=True)
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks() if column.num_chunks else pa.array([], column.type)
+
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        # Legacy form: strip brackets, quotes and commas, then split on whitespace
+        cleaned = pc.utf8_trim_whitespace(pc.replace_substring_regex(column, r"[\[\]'\",]", " "))
+        cleaned = pc.if_else(pc.equal(cleaned, ""), pa.scalar(None, cleaned.type), cleaned)
+        column = pc.utf8_split_whitespace(cleaned)
+    elif pa.types.is_null(column.type):
+        column = pa.array([None] * len(column), pa.list_(pa.string()))
+
+    lengths = pc.list_value_length(column).fill_null(0).to_numpy(zero_copy_only=False)
+    offsets = np.zeros(len(column) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = pc.list_flatten(column)
+    return offsets, values
+
+
+def row_index(offsets):
+    """Row number of every flat value, for CSR offsets."""
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+class CategoryDictionary:
+    """
+    Maps the 24 character category ids of the categories dataset to small
+    integer codes (int16 while there are fewer than 32767 categories, else
+    int32). Ids that are not in the categories dataset get code -1.
+    """
+
+    def __init__(self, categories):
+        if not isinstance(categories, pa.Table):
+            categories = pa.Table.from_pandas(categories, preserve_index=False)
+        self.ids = categories['category_id'].combine_chunks()
+        self.names = categories['category_name'].combine_chunks()
+        self.dtype = np.int16 if len(self.ids) < np.iinfo(np.int16).max else np.int32
+
+    def __len__(self):
+        return len(self.ids)
+
+    def encode(self, values):
+        """Codes of an array of category ids."""
+        codes = pc.index_in(values, value_set=self.ids).fill_null(-1)
+        return codes.to_numpy(zero_copy_only=False).astype(self.dtype)
+
+    def encode_lists(self, column):
+        """
+        Parse and encode an fsq_category_ids column into CSR form: offsets
+        (int32 when they fit) and the codes of every row's categories.
+        """
+        offsets, values = parse_fsq_category_ids(column)
+        if offsets[-1] < np.iinfo(np.int32).max:
+            offsets = offsets.astype(np.int32)
+        return offsets, self.encode(values)
+
+    def decode(self, codes):
+        """Category ids of an array of codes."""
+        return self.ids.take(pa.array(codes, pa.int32())).to_numpy(zero_copy_only=False)
+
+    def category_names(self, codes):
+        """Category names of an array of codes."""
+        return self.names.take(pa.array(codes, pa.int32())).to_numpy(zero_copy_only=False)
+
+    def codes_of(self, category_ids):
+        """Codes of a collection of category ids, ignoring unknown ids."""
+        codes = self.encode(pa.array(list(category_ids), pa.string()))
+        return codes[codes >= 0]
+
+
+def category_counts(codes, category_count):
+    """Number of occurrences of every category code (code -1, unknown ids, is skipped)."""
+    return np.bincount(codes[codes >= 0], minlength=category_count)
+
+
+def category_lookup(dictionary, category_ids):
+    """
+    Boolean lookup table over category codes that is True for the given ids.
+    It has one extra False entry at the end, so code -1 (unknown id) never matches.
+    """
+    lookup = np.zeros(len(dictionary) + 1, dtype=bool)
+    lookup[dictionary.codes_of(category_ids)] = True
+    return lookup
+
+
+def has_any_category(offsets, codes, lookup):
+    """Per-row mask of the rows with at least one category in the lookup table."""
+    matches = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum(lookup[codes], out=matches[1:])
+    return matches[offsets[1:]] > matches[offsets[:-1]]
@@ -0,0 +1,117 @@
+"""
+Compact in-memory places table.
+
+The places DataFrame of the scripts holds country as Python strings,
+coordinates as float64 and fsq_category_ids as object arrays of numpy string
+arrays: hundreds of bytes per row. The compact form keeps it a DataFrame but
+with
+
+- country as a categorical
+- latitude and longitude as float32, or as int32 microdegrees
+- fsq_category_ids replaced by category_codes, a pyarrow list<int16> column
+  of CategoryDictionary codes (-1 for ids not in the categories dataset)
+
+which is about 16 bytes per row.
+"""
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from fsq_aggregate import DensityAccumulator, iter_place_batches
+
+coordinate_modes = ("float32", "microdegrees")
+
+
+def compact_coordinates(column, coordinates):
+    if coordinates == "microdegrees":
+        return pc.round(pc.multiply(column.cast(pa.float64()), 1e6)).cast(pa.int32())
+    return column.cast(pa.float32())
+
+
+def compact_batch(batch, dictionary, coordinates="float32"):
+    """Arrow table of one places batch (or whole table) in the compact columns."""
+    if coordinates not in coordinate_modes:
+        raise ValueError(f"Unknown coordinates mode {coordinates}, use one of {coordinate_modes}.")
+    offsets, codes = dictionary.encode_lists(batch.column('fsq_category_ids'))
+    return pa.table({
+        'country': pc.dictionary_encode(batch.column('country')),
+        'latitude': compact_coordinates(batch.column('latitude'), coordinates),
+        'longitude': compact_coordinates(batch.column('longitude'), coordinates),
+        'category_codes': pa.ListArray.from_arrays(pa.array(offsets.astype(np.int32)), pa.array(codes)),
+    })
+
+
+def compact_types(arrow_type):
+    """to_pandas types: lists stay Arrow backed, int32 microdegrees keep nulls without becoming float64."""
+    if pa.types.is_list(arrow_type):
+        return pd.ArrowDtype(arrow_type)
+    if arrow_type == pa.int32():
+        return pd.Int32Dtype()
+    return None
+
+
+def to_compact_frame(tables):
+    table = pa.concat_tables(tables).unify_dictionaries()
+    return table.to_pandas(types_mapper=compact_types)
+
+
+def compact_places(places, dictionary, coordinates="float32"):
+    """The compact DataFrame of a places DataFrame or Arrow table with fsq_category_ids."""
+    if isinstance(places, pd.DataFrame):
+        places = pa.Table.from_pandas(places[['fsq_category_ids', 'latitude', 'longitude', 'country']],
+                                      preserve_index=False)
+    return to_compact_frame([compact_batch(places, dictionary, coordinates)])
+
+
+def load_compact_places(paths, dictionary, coordinates="float32"):
+    """
+    Read the places files batch by batch straight into the compact DataFrame,
+    so the object columns of the full dataset never exist.
+    """
+    return to_compact_frame([compact_batch(batch, dictionary, coordinates)
+                             for batch in iter_place_batches(paths)])
+
+
+def category_csr(frame):
+    """(offsets, codes) numpy arrays of the category_codes column."""
+    lists = pa.array(frame['category_codes'])
+    if isinstance(lists, pa.ChunkedArray):
+        lists = lists.combine_chunks()
+    offsets = lists.offsets.to_numpy()
+    return offsets - offsets[0], lists.values.to_numpy(zero_copy_only=False)[offsets[0]:offsets[-1]]
+
+
+def coordinates_degrees(frame, column):
+    """A coordinate column as float64 degrees, whichever compact mode it is in."""
+    values = frame[column]
+    if isinstance(values.dtype, pd.Int32Dtype):
+        return values.to_numpy(dtype=np.float64, na_value=np.nan) / 1e6
+    return values.to_numpy(dtype=np.float64)
+
+
+def aggregate_compact(frame, dictionary, lookup):
+    """DensityAccumulator of a compact DataFrame, for a lookup table over the dictionary it was encoded with."""
+    accumulator = DensityAccumulator(dictionary, lookup)
+    country_map = np.append(accumulator.countries.add(list(frame['country'].cat.categories)), np.int32(-1))
+    offsets, codes = category_csr(frame)
+    return accumulator.add_codes(country_map[frame['country'].cat.codes.to_numpy()], offsets, codes,
+                                 coordinates_degrees(frame, 'latitude'), coordinates_degrees(frame, 'longitude'))
+
+
+def bytes_per_row(frame):
+    """Bytes per row of every column and in total, as memory_usage(deep=True) counts them."""
+    usage = frame.memory_usage(deep=True, index=False) / max(len(frame), 1)
+    usage['total'] = usage.sum()
+    return usage
+
+
+def memory_report(before, after, world_rows=None):
+    """Print bytes per row of a DataFrame before and after compacting, optionally projected to world_rows rows."""
+    report = pd.DataFrame({'before': bytes_per_row(before), 'after': bytes_per_row(after)}).round(1)
+    print(f"Bytes per row:\n{report.fillna('-')}")
+    print(f"{report.loc['total', 'before'] / report.loc['total', 'after']:.1f}x smaller")
+    if world_rows:
+        print(f"Projected for {world_rows / 1e6:.1f}M places: {report.loc['total', 'before'] * world_rows / 1e9:.2f} GB "
+              f"before, {report.loc['total', 'after'] * world_rows / 1e9:.2f} GB after")
+    return report
@@ -0,0 +1,66 @@
+"""
+Bundled country reference table (country_reference.csv next to this file).
+
+One row per country with alpha_2 (the country column of the places), alpha_3
+(the id of the world GeoJSON), numeric, name and area_km2. It is read once
+per process; country columns are mapped to row numbers of the table with one
+categorical lookup, after which every attribute is an array take. No
+network access and no per-row pycountry calls.
+"""
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+reference_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "country_reference.csv")
+
+
+@functools.lru_cache(maxsize=None)
+def load_country_reference(path=reference_file):
+    """The country reference table as a DataFrame; its version is in attrs['version']."""
+    with open(path) as f:
+        version = f.readline().rsplit("version", 1)[-1].strip()
+    reference = pd.read_csv(path, comment="#", dtype={'numeric': str}, keep_default_na=False,
+                            na_values={'area_km2': ['']})
+    reference.attrs['version'] = version
+    return reference
+
+
+def country_codes(countries, reference=None, key='alpha_2'):
+    """Row numbers in the reference table of country codes (alpha-2 by default); -1 for null and unknown codes."""
+    reference = load_country_reference() if reference is None else reference
+    if isinstance(countries, (pa.Array, pa.ChunkedArray)):
+        countries = countries.to_pandas()
+    if isinstance(getattr(countries, 'dtype', None), pd.CategoricalDtype):
+        # Map the few categories, then take with the category codes
+        category_codes = country_codes(countries.cat.categories, reference, key)
+        return np.append(category_codes, -1)[countries.cat.codes.to_numpy()]
+    return pd.Categorical(countries, categories=reference[key]).codes.astype(np.int32)
+
+
+def attribute_table(reference, attribute):
+    """Values of an attribute per reference row, plus a missing value at the end for code -1."""
+    if attribute == 'area_km2':
+        return np.append(reference[attribute].to_numpy(dtype=np.float64), np.nan)
+    return np.append(reference[attribute].to_numpy(dtype=object), None)
+
+
+def country_attribute(countries, attribute, reference=None, key='alpha_2'):
+    """
+    An attribute (alpha_2, alpha_3, numeric, name, area_km2) of every country
+    code (alpha-2, or the key column); missing for unknown codes.
+    """
+    reference = load_country_reference() if reference is None else reference
+    return attribute_table(reference, attribute)[country_codes(countries, reference, key)]
+
+
+def enrich_countries(frame, column='country', attributes=('alpha_3', 'name', 'area_km2'), reference=None):
+    """A copy of frame with reference attributes of its alpha-2 country column added."""
+    reference = load_country_reference() if reference is None else reference
+    codes = country_codes(frame[column], reference)
+    frame = frame.copy()
+    for attribute in attributes:
+        frame[attribute] = attribute_table(reference, attribute)[codes]
+    return frame
@@ -0,0 +1,345 @@
+import hashlib
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import fsspec
+import requests
+import s3fs
+
+# Foursquare Open Source Places release on S3. FSQ_RELEASE_ROOT points every
+# stage at another copy instead, e.g. a local directory written by fsq_synthetic.py
+release_bucket = os.environ.get("FSQ_RELEASE_ROOT", "s3://fsq-os-places-us-east-1/release")
+release_date = "2024-11-19"
+
+# Number of parts fetched at the same time (and S3 connections kept open)
+max_connections = 8
+
+# Size of the buffer used to copy a part from S3 to disk
+chunk_size = 8 * 1024 * 1024
+
+# Retries with exponential backoff: backoff_base * 2 ** attempt seconds (with jitter)
+max_retries = 5
+backoff_base = 1.0
+
+
+def release_path(dataset, dt=release_date):
+    """S3 prefix of a dataset ('places' or 'categories') in a release."""
+    return f"{release_bucket}/dt={dt}/{dataset}/parquet/"
+
+
+def release_root_key(root=None):
+    """Short hash of a release root (default release_bucket), to keep local data of different roots apart."""
+    return hashlib.sha256((root or release_bucket).encode()).hexdigest()[:8]
+
+
+def get_filesystem(max_connections=max_connections, path=None):
+    """
+    Anonymous S3 filesystem with a connection pool sized for parallel downloads,
+    or the matching fsspec filesystem when path (default release_bucket) is not on S3.
+    """
+    path = path or release_bucket
+    if not path.startswith("s3://"):
+        return fsspec.core.url_to_fs(path)[0]
+    return s3fs.S3FileSystem(anon=True, config_kwargs={"max_pool_connections": max_connections})
+
+
+def list_parquet_parts(s3_dir_path, fs=None):
+    """List every Parquet part in an S3 prefix, with size, sorted by name."""
+    fs = fs or get_filesystem(path=s3_dir_path)
+    files = fs.ls(s3_dir_path, detail=True)
+    parts = sorted((f for f in files if f['name'].endswith('.parquet')), key=lambda f: f['name'])
+    if not parts:
+        raise FileNotFoundError(f"No Parquet file found in {s3_dir_path}")
+    return parts
+
+
+class ETagHasher:
+    """
+    Incremental S3 ETag of a stream: the MD5 of the content for single-part
+    uploads, or the MD5 of the part MD5s suffixed with '-N' for multipart ones.
+    """
+
+    def __init__(self, etag, size):
+        self.etag = etag.strip('"') if etag else None
+        self.parts = int(self.etag.split('-')[1]) if self.etag and '-' in self.etag else 0
+        self.part_size = multipart_part_size(size, self.parts) if self.parts else None
+        self.digests = []
+        self.current = hashlib.md5()
+        self.current_bytes = 0
+
+    def update(self, data):
+        if not self.parts:
+            self.current.update(data)
+            return
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self.part_size - self.current_bytes)
+            self.current.update(view[:take])
+            self.current_bytes += take
+            view = view[take:]
+            if self.current_bytes == self.part_size:
+                self.digests.append(self.current.digest())
+                self.current = hashlib.md5()
+                self.current_bytes = 0
+
+    def hexdigest(self):
+        if not self.parts:
+            return self.current.hexdigest()
+        digests = self.digests + ([self.current.digest()] if self.current_bytes else [])
+        return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def multipart_part_size(size, parts):
+    """Smallest whole number of MiB that splits size into the given number of parts."""
+    mib = 1024 * 1024
+    part_size = -(-size // parts)
+    return -(-part_size // mib) * mib
+
+
+def verify_download(local_path, written, size=None, etag=None, hasher=None):
+    """Raise if a downloaded file does not match the size and ETag reported by S3."""
+    if size is not None and written != size:
+        raise IOError(f"Size mismatch for {local_path}: got {written} bytes, expected {size}")
+    if not etag or hasher is None:
+        return
+    digest = hasher.hexdigest()
+    if digest == hasher.etag:
+        return
+    if hasher.parts:
+        # The multipart part size is guessed, so a mismatch is not proof of corruption
+        print(f"Warning: could not verify multipart ETag of {local_path} ({digest} != {hasher.etag})")
+    else:
+        raise IOError(f"ETag mismatch for {local_path}: got {digest}, expected {hasher.etag}")
+
+
+def load_sidecar(tmp_path, size=None, etag=None):
+    """
+    Return the number of bytes of tmp_path that a previous, interrupted transfer
+    completed, or 0 when there is nothing valid to resume from.
+    """
+    sidecar_path = tmp_path + ".json"
+    if not (os.path.exists(tmp_path) and os.path.exists(sidecar_path)):
+        return 0
+    try:
+        with open(sidecar_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    if state.get('size') != size or state.get('etag') != etag:
+        print(f"Remote file changed since {tmp_path} was started. Restarting download.")
+        return 0
+    # Only the range starting at byte 0 can be continued by appending
+    completed = next((end for start, end in merge_ranges(state.get('ranges', [])) if start == 0), 0)
+    return min(completed, os.path.getsize(tmp_path))
+
+
+def save_sidecar(tmp_path, remote, size, etag, ranges):
+    """Record the completed byte ranges of tmp_path next to it."""
+    sidecar_path = tmp_path + ".json"
+    with open(sidecar_path + ".tmp", 'w') as f:
+        json.dump({'remote': remote, 'size': size, 'etag': etag, 'ranges': merge_ranges(ranges)}, f)
+    os.replace(sidecar_path + ".tmp", sidecar_path)
+
+
+def remove_partial(tmp_path):
+    """Delete a partial download and its sidecar."""
+    for path in (tmp_path, tmp_path + ".json"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def merge_ranges(ranges):
+    """Merge overlapping or adjacent [start, end) byte ranges."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def resumable_copy(read_from, remote, local_path, size=None, etag=None, verify_etag=True):
+    """
+    Copy remote to local_path, resuming an interrupted transfer if possible.
+    read_from(offset) must yield chunks of the remote file starting at offset.
+    Data goes to local_path + '.part' with a JSON sidecar listing completed byte
+    ranges; the file is checked against size and ETag and then renamed over
+    local_path, so local_path is either complete or absent.
+    Returns the number of bytes transferred by this call.
+    """
+    tmp_path = local_path + ".part"
+    offset = load_sidecar(tmp_path, size, etag)
+    if offset == 0:
+        remove_partial(tmp_path)
+    else:
+        print(f"Resuming {remote} at byte {offset}" + (f" of {size}" if size else ""))
+    start_offset = offset
+
+    hasher = ETagHasher(etag, size) if etag and verify_etag else None
+    with open(tmp_path, 'r+b' if offset else 'wb') as local_file:
+        if hasher and offset:
+            # Re-hash the bytes already on disk; far cheaper than fetching them again
+            remaining = offset
+            while remaining:
+                chunk = local_file.read(min(chunk_size, remaining))
+                hasher.update(chunk)
+                remaining -= len(chunk)
+        local_file.seek(offset)
+        local_file.truncate()
+        for chunk in read_from(offset):
+            local_file.write(chunk)
+            if hasher:
+                hasher.update(chunk)
+            offset += len(chunk)
+            local_file.flush()
+            save_sidecar(tmp_path, remote, size, etag, [[0, offset]])
+        os.fsync(local_file.fileno())
+
+    try:
+        verify_download(local_path, offset, size, etag, hasher)
+    except IOError:
+        remove_partial(tmp_path)  # Corrupt data cannot be resumed
+        raise
+    os.replace(tmp_path, local_path)
+    os.remove(tmp_path + ".json")
+    return offset - start_offset
+
+
+def with_retries(func, description, retries=max_retries):
+    """Call func(), retrying with exponential backoff and jitter on errors."""
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff_base * 2 ** attempt * random.uniform(0.5, 1.5)
+            print(f"Error downloading {description} ({e}). Retry {attempt + 1}/{retries} in {delay:.1f}s...")
+            time.sleep(delay)
+
+
+def download_part(fs, remote_path, local_path, size=None, etag=None):
+    """
+    Stream a single part from S3 to local_path through a fixed-size buffer,
+    resuming with Range requests after an interruption and retrying with
+    exponential backoff. Returns the number of bytes transferred.
+    """
+    def read_from(offset):
+        with fs.open(remote_path, 'rb', block_size=chunk_size) as s3_file:
+            s3_file.seek(offset)  # Turned into a Range request by the filesystem
+            while True:
+                chunk = s3_file.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    resumed_from = load_sidecar(local_path + ".part", size, etag)
+    with_retries(lambda: resumable_copy(read_from, remote_path, local_path, size, etag), remote_path)
+    return os.path.getsize(local_path) - resumed_from
+
+
+def download_file(url, local_path):
+    """
+    Download url to local_path with requests, resuming interrupted transfers
+    with HTTP Range requests and retrying with exponential backoff. The body
+    is requested without content encoding, so Content-Length, Range offsets
+    and the bytes written all count the bytes of the file itself.
+    """
+    if os.path.exists(local_path):
+        print(f"{local_path} already exists. Skipping download.")
+        return
+
+    print(f"Downloading {url} to {local_path}...")
+    head = requests.head(url, allow_redirects=True, headers={'Accept-Encoding': 'identity'}, timeout=60)
+    head.raise_for_status()
+    size = int(head.headers['Content-Length']) if 'Content-Length' in head.headers else None
+    etag = head.headers.get('ETag')
+    if head.headers.get('Accept-Ranges') != 'bytes':
+        remove_partial(local_path + ".part")  # Server cannot resume, start from zero
+
+    def read_from(offset):
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = f"bytes={offset}-"
+            if etag:
+                headers['If-Range'] = etag
+        with requests.get(url, stream=True, headers=headers, timeout=60) as response:
+            response.raise_for_status()
+            skip = offset if response.status_code != 206 else 0  # Range ignored, full body sent
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if skip:
+                    dropped = min(skip, len(chunk))
+                    chunk, skip = chunk[dropped:], skip - dropped
+                if chunk:
+                    yield chunk
+
+    # HTTP ETags are opaque outside S3, so they only guard resumption here
+    with_retries(lambda: resumable_copy(read_from, url, local_path, size, etag, verify_etag=False), url)
+    print(f"Download successful: {local_path}")
+
+
+def download_parquet_parts(s3_dir_path, local_dir, max_workers=max_connections):
+    """
+    Download every Parquet part in s3_dir_path into local_dir using a bounded
+    thread pool. Parts that already exist with the expected size are skipped,
+    and interrupted parts resume from where they stopped.
+    Returns the list of local part paths, sorted by name.
+    """
+    fs = get_filesystem(max_workers, s3_dir_path)
+    parts = list_parquet_parts(s3_dir_path, fs)
+    return download_parts(fs, parts, local_dir, max_workers, s3_dir_path)
+
+
+def download_parts(fs, parts, local_dir, max_workers=max_connections, description="S3", etags=None):
+    """
+    Download the listed parts (as returned by list_parquet_parts) into local_dir
+    in parallel. Returns the list of local part paths in the order of parts.
+    A local part with the listed size is kept, unless etags (file name ->
+    ETag it was downloaded with) is given and its ETag differs from the
+    listed one.
+    """
+    os.makedirs(local_dir, exist_ok=True)
+
+    local_paths = []
+    pending = []
+    for part in parts:
+        local_path = os.path.join(local_dir, os.path.basename(part['name']))
+        local_paths.append(local_path)
+        current = (etags is None or not part.get('ETag')
+                   or etags.get(os.path.basename(part['name'])) == part['ETag'])
+        if current and os.path.exists(local_path) and os.path.getsize(local_path) == part['size']:
+            continue
+        pending.append((part, local_path))
+
+    if not pending:
+        print(f"All {len(parts)} parts of {description} already in {local_dir}. Skipping download.")
+        return local_paths
+
+    print(f"Downloading {len(pending)} of {len(parts)} parts from {description} "
+          f"to {local_dir} with {max_workers} connections...")
+    start = time.monotonic()
+    total_bytes = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(download_part, fs, part['name'], local, part['size'], part.get('ETag')): part['name']
+            for part, local in pending
+        }
+        for future in as_completed(futures):
+            remote = futures[future]
+            try:
+                total_bytes += future.result()
+            except Exception as e:
+                print(f"Error downloading {remote}: {e}")
+                raise
+            elapsed = time.monotonic() - start
+            print(f"  {os.path.basename(remote)} done, "
+                  f"{total_bytes / 1e6:.1f} MB at {total_bytes / 1e6 / max(elapsed, 1e-6):.1f} MB/s")
+
+    elapsed = time.monotonic() - start
+    print(f"Download successful: {total_bytes / 1e6:.1f} MB in {elapsed:.1f}s "
+          f"({total_bytes / 1e6 / max(elapsed, 1e-6):.1f} MB/s aggregate)")
+    return local_paths
@@ -0,0 +1,335 @@
+"""
+Incremental country x category counts between Foursquare releases.
+
+The counts of a release (places per country with a category of the filter
+set, and (country, category_id) pair counts) are stored under
+<state_dir>/<key>/dt=<release>/, where key is a hash of the release root and
+the filter set, together with places.parquet: the fsq_place_id, country and
+matching category ids of every place with a category of the filter set, the
+only places the counts depend on.
+
+A new release is counted from the newest stored earlier release. Foursquare
+sets date_refreshed (or date_closed) when a place changes, so only the row
+groups whose statistics of those columns reach the earlier release date are
+read and parsed, and of those only the refreshed places: their stored rows
+are replaced by their new ones. Deleted places are found by an anti-join of
+the stored ids against the fsq_place_id column of the new release, the only
+column read in full. Parsing categories and applying the changes take time
+proportional to the churn; what remains proportional to the size is the
+pass over the id column and reading and writing the stored places of the
+filter set. A release without the date columns or their statistics is read
+in full, which gives the same counts.
+"""
+import functools
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import fsq_aggregate
+from fsq_aggregate import iter_place_batches, plan_shards, process_context
+from fsq_cache import cache_key
+from fsq_categories import CategoryDictionary, category_lookup
+from fsq_mirror import mirror_release, resolve_release
+from fsq_preview import place_id_hashes
+
+state_dir = "fsq_incremental"
+
+track_columns = ['fsq_place_id', 'country', 'fsq_category_ids']
+
+# A place with one of these dates on or after the earlier release date has changed since
+refresh_columns = ['date_refreshed', 'date_closed']
+
+
+def state_path(key, dt):
+    return os.path.join(state_dir, key, f"dt={dt}")
+
+
+def stored_releases(key):
+    """Release dates with stored counts and places for a filter key, oldest first."""
+    key_dir = os.path.join(state_dir, key)
+    if not os.path.isdir(key_dir):
+        return []
+    return sorted(name[len("dt="):] for name in os.listdir(key_dir)
+                  if name.startswith("dt=") and os.path.exists(os.path.join(key_dir, name, "places.parquet")))
+
+
+def load_state(key, dt):
+    """(country_counts, pair_counts) stored for a release, or None."""
+    path = state_path(key, dt)
+    if not os.path.isdir(path):
+        return None
+    return (pd.read_parquet(os.path.join(path, "country_counts.parquet")),
+            pd.read_parquet(os.path.join(path, "pair_counts.parquet")))
+
+
+def load_tracked(key, dt):
+    """The tracked places stored for a release (see track_batch)."""
+    return pq.read_table(os.path.join(state_path(key, dt), "places.parquet"))
+
+
+def save_state(key, dt, country_counts, pair_counts, tracked):
+    path = state_path(key, dt)
+    shutil.rmtree(path + ".tmp", ignore_errors=True)
+    os.makedirs(path + ".tmp")
+    country_counts.to_parquet(os.path.join(path + ".tmp", "country_counts.parquet"), index=False)
+    pair_counts.to_parquet(os.path.join(path + ".tmp", "pair_counts.parquet"), index=False)
+    pq.write_table(tracked, os.path.join(path + ".tmp", "places.parquet"), compression="zstd")
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(path + ".tmp", path)
+
+
+def track_batch(batch, dictionary, lookup):
+    """
+    The places of a batch with at least one category of the lookup table:
+    fsq_place_id, country and category_ids, the ids of only their matching
+    categories (in their order, a repeated id counts twice like in the
+    aggregation).
+    """
+    offsets, codes = dictionary.encode_lists(batch.column('fsq_category_ids'))
+    matching = lookup[codes]
+    matching_before = np.zeros(len(codes) + 1, dtype=np.int32)
+    np.cumsum(matching, out=matching_before[1:])
+    matching_offsets = matching_before[offsets]
+    category_ids = pa.ListArray.from_arrays(pa.array(matching_offsets),
+                                            dictionary.ids.take(pa.array(codes[matching].astype(np.int32))))
+    rows = pa.array(np.diff(matching_offsets) > 0)
+    return pa.table({
+        'fsq_place_id': batch.column('fsq_place_id'),
+        'country': batch.column('country'),
+        'category_ids': category_ids,
+    }).filter(rows)
+
+
+def track_shard(shard, dictionary, lookup, batch_rows=None):
+    """Worker: the tracked places of the row groups of one shard."""
+    path, row_groups = shard
+    return pa.concat_tables([track_batch(batch, dictionary, lookup)
+                             for batch in iter_place_batches(path, columns=track_columns,
+                                                             batch_rows=batch_rows, row_groups=row_groups)])
+
+
+def refreshed_row_groups(path, since):
+    """
+    Row groups of a places file that may hold a place refreshed or closed on
+    or after since, from the column statistics. Files without date_refreshed
+    and row groups without statistics are read in full.
+    """
+    metadata = pq.ParquetFile(path).metadata
+    columns = {metadata.schema.column(i).name: i for i in range(metadata.num_columns)}
+    if 'date_refreshed' not in columns:
+        return list(range(metadata.num_row_groups))
+    row_groups = []
+    for index in range(metadata.num_row_groups):
+        row_group = metadata.row_group(index)
+        for name in refresh_columns:
+            if name not in columns:
+                continue
+            statistics = row_group.column(columns[name]).statistics
+            if statistics is not None and statistics.has_null_count and statistics.null_count == row_group.num_rows:
+                continue
+            if statistics is None or not statistics.has_min_max or str(statistics.max) >= since:
+                row_groups.append(index)
+                break
+    return row_groups
+
+
+def refresh_shard(shard, dictionary, lookup, since, batch_rows=None):
+    """
+    Worker: the ids of the places of one shard refreshed or closed on or after
+    since, and the tracked places among them.
+    """
+    path, row_groups = shard
+    names = pq.ParquetFile(path).schema_arrow.names
+    dates = [name for name in refresh_columns if name in names]
+    ids, tracked = [], []
+    for batch in iter_place_batches(path, columns=track_columns + dates, batch_rows=batch_rows,
+                                    row_groups=row_groups):
+        refreshed = pa.array(np.ones(batch.num_rows, dtype=bool))
+        if 'date_refreshed' in dates:
+            refreshed = functools.reduce(pc.or_, [
+                pc.fill_null(pc.greater_equal(pc.cast(batch.column(name), pa.string()), since), False)
+                for name in dates])
+        batch = batch.filter(refreshed)
+        ids.append(batch.column('fsq_place_id'))
+        tracked.append(track_batch(batch, dictionary, lookup))
+    return pa.chunked_array(ids, pa.string()), pa.concat_tables(tracked)
+
+
+def map_release(function, shards, max_workers, *args):
+    """function(shard, *args) of every shard, in shard order, over a process pool."""
+    max_workers = max_workers or fsq_aggregate.max_processes or os.cpu_count()
+    if max_workers == 1 or len(shards) <= 1:
+        return [function(shard, *args) for shard in shards]
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=process_context()) as executor:
+        return list(executor.map(function, shards, *([arg] * len(shards) for arg in args)))
+
+
+def check_unique(tracked, release_date):
+    """Raise on duplicate fsq_place_ids: places are matched by id, so a duplicate would make the counts drift."""
+    duplicates = tracked.num_rows - pc.count_distinct(tracked['fsq_place_id']).as_py()
+    if duplicates:
+        raise ValueError(f"Release dt={release_date} has {duplicates} duplicate fsq_place_id values among the "
+                         "places of the filter set; incremental counts need unique ids.")
+
+
+def track_release(paths, dictionary, lookup, max_workers=None, release_date=None):
+    """The tracked places of a whole release, streamed shard by shard over a process pool."""
+    tracked = pa.concat_tables(map_release(track_shard, plan_shards(paths), max_workers, dictionary, lookup))
+    tracked = tracked.combine_chunks()
+    check_unique(tracked, release_date)
+    return tracked
+
+
+def present_places(paths, place_ids, batch_rows=None):
+    """
+    Which of place_ids are in the places files, from an anti-join over only
+    their fsq_place_id column: the ids of every batch go through a bitmap of
+    the high bits of the 64-bit hashes of place_ids, the few that pass are
+    looked up in the sorted hashes and the candidates are compared exactly.
+    """
+    present = np.zeros(len(place_ids), dtype=bool)
+    if not len(place_ids):
+        return present
+    hashes = place_id_hashes(place_ids)
+    order = np.argsort(hashes)
+    sorted_hashes = hashes[order]
+    collisions = np.any(sorted_hashes[1:] == sorted_hashes[:-1])  # Then every id is compared instead
+    # About 16 bitmap entries per id, so most ids of the batches that are not in place_ids stop at the bitmap
+    shift = np.uint64(64 - max(10, int(np.ceil(np.log2(len(place_ids)))) + 4))
+    bitmap = np.zeros(1 << (64 - int(shift)), dtype=bool)
+    bitmap[hashes >> shift] = True
+    for batch in iter_place_batches(paths, columns=['fsq_place_id'], batch_rows=batch_rows):
+        batch_ids = batch.column('fsq_place_id')
+        if collisions:
+            present |= pc.is_in(place_ids, value_set=batch_ids).to_numpy(zero_copy_only=False)
+            continue
+        batch_hashes = place_id_hashes(batch_ids)
+        maybe = np.flatnonzero(bitmap[batch_hashes >> shift])
+        maybe = maybe[np.argsort(batch_hashes[maybe])]  # Sorted keys make searchsorted cache friendly
+        positions = np.minimum(np.searchsorted(sorted_hashes, batch_hashes[maybe]), len(sorted_hashes) - 1)
+        matched = sorted_hashes[positions] == batch_hashes[maybe]
+        candidates, rows = maybe[matched], order[positions[matched]]
+        equal = pc.equal(place_ids.take(pa.array(rows)), batch_ids.take(pa.array(candidates)))
+        present[rows[equal.to_numpy(zero_copy_only=False)]] = True
+    return present
+
+
+def update_release(paths, dictionary, lookup, stored, since, max_workers=None, release_date=None):
+    """
+    The tracked places of a release from the stored ones of the release
+    since: stored places that were deleted or refreshed are removed, and the
+    refreshed places with a category of the filter set are added. Returns
+    (tracked, removed, added, stats).
+    """
+    shards = [(path, [row_group]) for path in ([paths] if isinstance(paths, str) else paths)
+              for row_group in refreshed_row_groups(path, since)]
+    total_row_groups = sum(pq.ParquetFile(path).metadata.num_row_groups
+                           for path in ([paths] if isinstance(paths, str) else paths))
+    results = map_release(refresh_shard, shards, max_workers, dictionary, lookup, since)
+    refreshed_ids = pa.chunked_array([ids for ids, _ in results], pa.string())
+    added = pa.concat_tables([tracked for _, tracked in results] or [stored.slice(0, 0)]).cast(stored.schema)
+
+    stored_ids = stored['fsq_place_id'].combine_chunks()
+    deleted = ~present_places(paths, stored_ids)
+    removed_rows = deleted | pc.is_in(stored_ids, value_set=refreshed_ids.combine_chunks()).to_numpy(
+        zero_copy_only=False)
+    removed = stored.filter(pa.array(removed_rows))
+    # Added places are refreshed ones, whose stored rows are all removed, so only they can repeat an id
+    check_unique(added, release_date)
+    tracked = pa.concat_tables([stored.filter(pa.array(~removed_rows)), added]).combine_chunks()
+    stats = {
+        'row_groups': len(shards),
+        'total_row_groups': total_row_groups,
+        'refreshed': len(refreshed_ids),
+        'deleted': int(deleted.sum()),
+        'removed': removed.num_rows,
+        'added': added.num_rows,
+    }
+    return tracked, removed, added, stats
+
+
+def tracked_counts(tracked):
+    """(country_counts, pair_counts) of tracked places, as DensityAccumulator counts them."""
+    located = tracked.filter(pc.is_valid(tracked['country'])).combine_chunks()
+    category_ids = located['category_ids'].combine_chunks()
+    country_counts = (located.group_by('country').aggregate([('fsq_place_id', 'count')]).to_pandas()
+                      .rename(columns={'fsq_place_id_count': 'poi_count'}))
+    pairs = pa.table({
+        'country': located['country'].take(pc.list_parent_indices(category_ids)),
+        'category_id': pc.list_flatten(category_ids),
+    })
+    pair_counts = (pairs.group_by(['country', 'category_id']).aggregate([('category_id', 'count')]).to_pandas()
+                   .rename(columns={'category_id_count': 'poi_count'}))
+    return (country_counts.astype({'poi_count': 'int64'}).sort_values('country', ignore_index=True),
+            pair_counts.astype({'poi_count': 'int64'}).sort_values(['country', 'category_id'], ignore_index=True))
+
+
+def combine(signed_frames, keys):
+    """Sum the poi_count of (frame, sign) pairs per key; rows that sum to zero are dropped."""
+    total = pd.concat([frame.assign(poi_count=frame['poi_count'] * sign) for frame, sign in signed_frames])
+    total = total.groupby(keys, as_index=False)['poi_count'].sum()
+    if (total['poi_count'] < 0).any():
+        raise ValueError("Negative counts after applying a release diff; the stored state does not match.")
+    total = total[total['poi_count'] != 0].astype({'poi_count': 'int64'})
+    return total.sort_values(keys, ignore_index=True)
+
+
+def incremental_counts(release_date, category_ids, max_workers=None):
+    """
+    (country_counts, pair_counts) of a release for a category filter set:
+    stored, updated from the newest stored earlier release with only the
+    places refreshed or deleted since (see update_release), or computed in
+    full when there is no earlier release for this filter set. Only the new
+    release is mirrored. release_date=None is the newest release on S3.
+    """
+    release_date = resolve_release(release_date)
+    key = cache_key(None, category_ids, name="incremental")
+    state = load_state(key, release_date)
+    if state is not None:
+        print(f"Using stored counts of dt={release_date}")
+        return state
+
+    new_parts = mirror_release(release_date)
+    dictionary = CategoryDictionary(pq.read_table(new_parts['categories']))
+    lookup = category_lookup(dictionary, category_ids)
+    start = time.perf_counter()
+    earlier = [dt for dt in stored_releases(key) if dt < release_date]
+    if not earlier:
+        print(f"No earlier release stored, counting dt={release_date} in full")
+        tracked = track_release(new_parts['places'], dictionary, lookup, max_workers, release_date)
+        print(f"Streamed dt={release_date}: {tracked.num_rows} places with a category of the filter set "
+              f"({time.perf_counter() - start:.1f}s)")
+        country_counts, pair_counts = tracked_counts(tracked)
+    else:
+        previous = earlier[-1]
+        old_country_counts, old_pair_counts = load_state(key, previous)
+        tracked, removed, added, stats = update_release(new_parts['places'], dictionary, lookup,
+                                                        load_tracked(key, previous), previous, max_workers,
+                                                        release_date)
+        print(f"dt={previous} -> dt={release_date}: read {stats['row_groups']} of {stats['total_row_groups']} "
+              f"row groups, {stats['refreshed']} places refreshed and {stats['deleted']} places of the filter set "
+              f"deleted since ({time.perf_counter() - start:.1f}s)")
+        removed_countries, removed_pairs = tracked_counts(removed)
+        added_countries, added_pairs = tracked_counts(added)
+        country_counts = combine([(old_country_counts, 1), (removed_countries, -1), (added_countries, 1)],
+                                 ['country'])
+        pair_counts = combine([(old_pair_counts, 1), (removed_pairs, -1), (added_pairs, 1)],
+                              ['country', 'category_id'])
+        print(f"Applied {stats['removed']} removed and {stats['added']} added places of the filter set")
+    save_state(key, release_date, country_counts, pair_counts, tracked)
+    print(f"Counts of dt={release_date} ready in {time.perf_counter() - start:.1f}s")
+    return country_counts, pair_counts
+
+
+def category_density(pair_counts, categories):
+    """The (country, category_name, poi_count) beer_density frame from pair counts."""
+    names = categories[['category_id', 'category_name']]
+    density = pair_counts.merge(names, on='category_id')[['country', 'category_name', 'poi_count']]
+    return density.sort_values(['country', 'category_name'], ignore_index=True)
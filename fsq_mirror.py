@@ -0,0 +1,180 @@
+import json
+import os
+import shutil
+import time
+
+from fsq_download import (
+    release_bucket, release_path, release_root_key, max_connections,
+    get_filesystem, list_parquet_parts, download_parts,
+)
+
+# Local mirror of Foursquare releases: <mirror_dir>/<release root key>/dt=<release>/<dataset>/<part files>,
+# so releases of the same date from different release roots (S3, a synthetic root) sit side by side
+mirror_dir = "fsq_mirror"
+
+# Disk budget for the whole mirror; least recently used releases are evicted above it
+disk_budget = 200 * 1024 ** 3
+
+datasets = ("places", "categories")
+
+
+def manifest_path():
+    return os.path.join(mirror_dir, "manifest.json")
+
+
+def load_manifest():
+    """
+    Read the mirror manifest, or an empty one if the mirror is new. Releases
+    mirrored before the mirror was keyed by release root are dropped, with
+    their files.
+    """
+    manifest_file = manifest_path()
+    if not os.path.exists(manifest_file):
+        return {'releases': {}}
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    for key in [key for key in manifest['releases'] if '/' not in key]:
+        print(f"Dropping release dt={key} mirrored without its release root")
+        shutil.rmtree(os.path.join(mirror_dir, f"dt={key}"), ignore_errors=True)
+        del manifest['releases'][key]
+    return manifest
+
+
+def save_manifest(manifest):
+    """Write the mirror manifest atomically."""
+    os.makedirs(mirror_dir, exist_ok=True)
+    manifest_file = manifest_path()
+    with open(manifest_file + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def release_key(dt):
+    """Manifest key of release dt of the current release root: <release root key>/dt=<dt>."""
+    return f"{release_root_key()}/dt={dt}"
+
+
+def release_dir(dt=None, key=None):
+    """Local directory of release dt of the current release root, or of a manifest key."""
+    return os.path.join(mirror_dir, *(key or release_key(dt)).split('/'))
+
+
+def list_releases(fs=None):
+    """Release dates available on S3, oldest first."""
+    fs = fs or get_filesystem()
+    names = [os.path.basename(p.rstrip('/')) for p in fs.ls(release_bucket)]
+    return sorted(name[len("dt="):] for name in names if name.startswith("dt="))
+
+
+def resolve_release(dt=None, fs=None):
+    """The release date dt, or the newest release on S3 when dt is None."""
+    if dt is not None:
+        return dt
+    dt = list_releases(fs)[-1]
+    print(f"Latest release is dt={dt}")
+    return dt
+
+
+def cached_parts(manifest, dt, dataset):
+    """
+    Local part paths of a dataset if the manifest lists it, it was mirrored
+    from the current release root and every part on disk has the recorded
+    size, otherwise None.
+    """
+    entry = manifest['releases'].get(release_key(dt), {}).get('datasets', {}).get(dataset)
+    if not entry or entry.get('source') != release_path(dataset, dt):
+        return None
+    local_dir = os.path.join(release_dir(dt), dataset)
+    paths = [os.path.join(local_dir, part['file']) for part in entry['parts']]
+    for path, part in zip(paths, entry['parts']):
+        if not os.path.exists(path) or os.path.getsize(path) != part['size']:
+            return None
+    return paths
+
+
+def mirror_release(dt=None, names=datasets, max_workers=max_connections):
+    """
+    Make the given datasets of release dt available locally and return a dict
+    of dataset name -> list of local part paths. dt=None picks the newest
+    release on S3.
+    Datasets already valid in the manifest are used without any network access.
+    """
+    manifest = load_manifest()
+    fs = None
+    if dt is None:
+        fs = get_filesystem(max_workers)
+        dt = resolve_release(dt, fs)
+
+    local_parts = {}
+    for dataset in names:
+        local_dir = os.path.join(release_dir(dt), dataset)
+        paths = cached_parts(manifest, dt, dataset)
+        if paths is not None:
+            print(f"Using cached {dataset} for dt={dt} from {local_dir}")
+            local_parts[dataset] = paths
+            continue
+
+        fs = fs or get_filesystem(max_workers)
+        s3_dir_path = release_path(dataset, dt)
+        parts = list_parquet_parts(s3_dir_path, fs)
+        # Local parts count as downloaded only with the ETag the listing has now
+        entry = manifest['releases'].get(release_key(dt), {}).get('datasets', {}).get(dataset, {'parts': []})
+        etags = {part['file']: part['etag'] for part in entry['parts']}
+        local_parts[dataset] = download_parts(fs, parts, local_dir, max_workers, s3_dir_path, etags)
+
+        # Drop files of an older listing that are no longer part of the dataset
+        wanted = {os.path.basename(part['name']) for part in parts}
+        for name in os.listdir(local_dir):
+            if name not in wanted:
+                os.remove(os.path.join(local_dir, name))
+
+        release = manifest['releases'].setdefault(release_key(dt), {'dt': dt, 'root': release_bucket, 'datasets': {}})
+        release['datasets'][dataset] = {
+            'source': s3_dir_path,
+            'parts': [
+                {'file': os.path.basename(part['name']), 'size': part['size'], 'etag': part.get('ETag')}
+                for part in parts
+            ],
+        }
+        save_manifest(manifest)
+
+    manifest['releases'][release_key(dt)]['last_used'] = time.time()
+    save_manifest(manifest)
+    evict_releases(manifest, keep=release_key(dt))
+    return local_parts
+
+
+def release_size(manifest, key):
+    """Bytes on disk used by a mirrored release (by manifest key) according to the manifest."""
+    return sum(
+        part['size']
+        for entry in manifest['releases'][key]['datasets'].values()
+        for part in entry['parts']
+    )
+
+
+def evict_releases(manifest=None, budget=None, keep=None):
+    """
+    Delete least recently used releases, of any release root, until the
+    mirror fits in budget bytes (default disk_budget). keep is the manifest
+    key of a release that stays.
+    """
+    manifest = manifest or load_manifest()
+    budget = disk_budget if budget is None else budget
+    total = sum(release_size(manifest, key) for key in manifest['releases'])
+    by_age = sorted(manifest['releases'], key=lambda key: manifest['releases'][key].get('last_used', 0))
+    for key in by_age:
+        if total <= budget:
+            break
+        if key == keep:
+            continue
+        release = manifest['releases'][key]
+        size = release_size(manifest, key)
+        print(f"Evicting release dt={release['dt']} of {release['root']} ({size / 1e9:.1f} GB) "
+              f"to stay under {budget / 1e9:.1f} GB")
+        shutil.rmtree(release_dir(key=key), ignore_errors=True)
+        del manifest['releases'][key]
+        total -= size
+    save_manifest(manifest)
+    if total > budget:
+        print(f"Warning: release {keep} alone ({total / 1e9:.1f} GB) exceeds the mirror budget")
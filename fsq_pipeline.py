@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+# Fetched items waiting to be processed. At most prefetch_depth items sit in the
+# queue, plus one being fetched and one being processed, which caps memory.
+prefetch_depth = 2
+
+_done = object()
+
+
+async def _produce(sources, fetch, queue, timings):
+    try:
+        for source in sources:
+            start = time.monotonic()
+            item = await asyncio.to_thread(fetch, source)
+            timings['fetch'] += time.monotonic() - start
+            await queue.put(item)
+    except Exception as e:
+        await queue.put(e)  # Hand the error to the consumer so it does not wait forever
+        return
+    await queue.put(_done)
+
+
+async def _consume(queue, process, timings):
+    results = []
+    while True:
+        item = await queue.get()
+        if item is _done:
+            return results
+        if isinstance(item, Exception):
+            raise item
+        start = time.monotonic()
+        results.append(await asyncio.to_thread(process, item))
+        timings['process'] += time.monotonic() - start
+
+
+async def prefetch_pipeline(sources, fetch, process, depth=None):
+    """
+    Fetch item N+1 while item N is processed. fetch(source) and process(item)
+    run on worker threads; a bounded queue keeps at most depth fetched items
+    waiting. Returns the results of process in source order.
+    """
+    queue = asyncio.Queue(maxsize=depth or prefetch_depth)
+    timings = {'fetch': 0.0, 'process': 0.0}
+    start = time.monotonic()
+    producer = asyncio.create_task(_produce(sources, fetch, queue, timings))
+    try:
+        results = await _consume(queue, process, timings)
+    finally:
+        producer.cancel()
+    elapsed = time.monotonic() - start
+    print(f"Pipeline: fetch {timings['fetch']:.1f}s, process {timings['process']:.1f}s, "
+          f"wall {elapsed:.1f}s (serial would be {timings['fetch'] + timings['process']:.1f}s)")
+    return results
+
+
+def run_pipeline(sources, fetch, process, depth=None):
+    """Synchronous entry point for prefetch_pipeline."""
+    return asyncio.run(prefetch_pipeline(list(sources), fetch, process, depth))
@@ -0,0 +1,227 @@
+"""
+Fast previews of the aggregates while iterating on map styling.
+
+pd.read_parquet(..., nrows=10000) as in fivestar2.py - fivestar7.py does not
+limit anything with the pyarrow engine. Two previews that do:
+
+- preview_aggregate: exact counts of only the first K row groups, from the
+  local files or (remote_preview_aggregate) straight from the release root,
+  fetching only those row groups, so nothing has to be mirrored first.
+- sample_aggregate: a sample of places stratified by country. A place is in
+  the sample when a hash of its fsq_place_id (with sample_seed) is below the
+  rate of its country, so the sample is the same on every run and grows
+  consistently with the rate. Counts are scaled up by 1 / rate with 95%
+  confidence intervals. Drawing the sample is a full scan of the local
+  places files (so of a mirrored release); it is written to
+  <sample_dir>/<key>/, keyed by the release root, the files, the rates and
+  the seed, and later runs read only the sample.
+"""
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from fsq_aggregate import DensityAccumulator, batch_size, iter_place_batches, plan_shards
+from fsq_download import list_parquet_parts, release_bucket
+from fsq_remote import fetch_footer, places_columns, read_remote_parquet, remote_filesystem
+from fsq_synthetic import splitmix64
+
+# Row groups read by preview_aggregate
+preview_row_groups = 2
+
+# Base sampling rate, and the expected sample size per country that small countries are sampled up to
+sample_rate = 0.01
+min_country_samples = 1000
+
+# Seed of the fsq_place_id hash; another seed draws another sample
+sample_seed = 0
+
+# Normal quantile of the confidence intervals (95%)
+confidence_z = 1.96
+
+# 95% upper bound of a count of which no place was sampled, in units of (1 - rate) / rate (rule of three)
+zero_count_bound = 3.0
+
+sample_dir = os.path.join("fsq_cache", "sample")
+
+
+def preview_aggregate(paths, dictionary, lookup, row_groups=None):
+    """A DensityAccumulator over only the first row_groups row groups of the places files."""
+    row_groups = row_groups or preview_row_groups
+    accumulator = DensityAccumulator(dictionary, lookup)
+    for path, groups in plan_shards(paths, 1)[:row_groups]:
+        for batch in iter_place_batches(path, row_groups=groups):
+            accumulator.add(batch)
+    print(f"Preview of the first {row_groups} row groups: {accumulator.rows} places")
+    return accumulator
+
+
+def remote_preview_aggregate(dir_path, dictionary, lookup, row_groups=None, fs=None):
+    """
+    preview_aggregate straight from a remote places directory (an S3 prefix or
+    any release root): only the footers and the places_columns chunks of the
+    first row_groups row groups are fetched.
+    """
+    row_groups = row_groups or preview_row_groups
+    fs = fs or remote_filesystem(dir_path)
+    start = time.perf_counter()
+    accumulator = DensityAccumulator(dictionary, lookup)
+    remaining, transferred = row_groups, 0
+    for part in list_parquet_parts(dir_path, fs):
+        if remaining <= 0:
+            break
+        footer = fetch_footer(part['name'], fs, part.get('size'))
+        groups = list(range(min(remaining, footer[1].num_row_groups)))
+        table, fetched, _ = read_remote_parquet(part['name'], places_columns, fs, groups, footer=footer)
+        for batch in table.to_batches(max_chunksize=batch_size):
+            accumulator.add(batch)
+        remaining -= len(groups)
+        transferred += footer[2] + fetched
+    print(f"Preview of the first {row_groups} row groups of {dir_path}: {accumulator.rows} places, "
+          f"{transferred / 1e6:.1f} MB fetched in {time.perf_counter() - start:.1f}s")
+    return accumulator
+
+
+def place_id_hashes(place_ids, seed=None):
+    """Seeded 64-bit hash (uint64) of the first 32 bytes of every fsq_place_id."""
+    seed = sample_seed if seed is None else seed
+    if isinstance(place_ids, pa.ChunkedArray):
+        place_ids = place_ids.combine_chunks()
+    place_ids = place_ids.fill_null('')
+    lengths = pc.min_max(pc.binary_length(place_ids)).as_py()
+    if len(place_ids) and lengths['min'] == lengths['max']:
+        # Fixed length ids (all of them in the releases): read the string data directly
+        width = lengths['min']
+        offset_type = np.int64 if pa.types.is_large_string(place_ids.type) else np.int32
+        start = np.frombuffer(place_ids.buffers()[1], dtype=offset_type)[place_ids.offset]
+        data = np.frombuffer(place_ids.buffers()[2], dtype=np.uint8)[start:start + width * len(place_ids)]
+        raw = np.zeros((len(place_ids), 32), dtype=np.uint8)
+        raw[:, :min(width, 32)] = data.reshape(-1, width)[:, :32]
+    else:
+        padded = pc.utf8_rpad(pc.utf8_slice_codeunits(place_ids, 0, 32), 32, ' ')
+        raw = np.frombuffer(padded.cast(pa.binary()).cast(pa.binary(32)).buffers()[1], dtype=np.uint8)
+        raw = raw.reshape(-1, 32)
+    words = raw.view(np.uint64)
+    with np.errstate(over='ignore'):
+        hashed = splitmix64(words[:, 0] ^ splitmix64(words[:, 1] ^ (words[:, 2] * np.uint64(3))
+                                                     ^ (words[:, 3] * np.uint64(5)) ^ np.uint64(seed)))
+    return hashed
+
+
+def place_id_fractions(place_ids, seed=None):
+    """Deterministic uniform number in [0, 1) per fsq_place_id, from place_id_hashes."""
+    return (place_id_hashes(place_ids, seed) >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+def sampling_rates(populations, rate=None, min_samples=None):
+    """Sampling rate per country: the base rate, raised so every country expects min_samples places."""
+    rate = rate or sample_rate
+    min_samples = min_samples or min_country_samples
+    return {country: min(1.0, max(rate, min_samples / count)) for country, count in populations.items()}
+
+
+def sample_path(paths, rate=None, min_samples=None, seed=None):
+    """Directory of the sample of a set of places files, a hash of everything the sample depends on."""
+    inputs = {
+        'root': release_bucket,
+        'files': [[os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)]
+                  for path in ([paths] if isinstance(paths, str) else paths)],
+        'rate': rate or sample_rate,
+        'min_samples': min_samples or min_country_samples,
+        'seed': sample_seed if seed is None else seed,
+    }
+    return os.path.join(sample_dir, hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()[:16])
+
+
+def build_sample(paths, path, rate=None, min_samples=None, seed=None):
+    """
+    Draw the sample of the places files in one pass and write it to path:
+    sample.parquet (the sampled places) and rates.json (the population and
+    sampling rate of every country). The populations are only known at the
+    end, so every batch keeps the places below the rate its country would
+    have if no more of its places followed, an upper bound of the final rate;
+    the final rates then select the sample from those candidates.
+    """
+    start = time.perf_counter()
+    min_samples = min_samples or min_country_samples
+    populations = {}
+    candidates = []
+    for batch in iter_place_batches(paths, columns=['fsq_place_id'] + places_columns):
+        encoded = pc.dictionary_encode(batch.column('country'))
+        names = encoded.dictionary.to_pylist()
+        country_index = encoded.indices.fill_null(-1).to_numpy(zero_copy_only=False)
+        for name, count in zip(names, np.bincount(country_index[country_index >= 0], minlength=len(names))):
+            populations[name] = populations.get(name, 0) + int(count)
+        bounds = sampling_rates({name: populations[name] for name in names}, rate, min_samples)
+        row_bounds = np.array([bounds[name] for name in names] + [0.0])[country_index]
+        fractions = place_id_fractions(batch.column('fsq_place_id'), seed)
+        keep = fractions < row_bounds
+        candidates.append(pa.Table.from_batches([batch.filter(pa.array(keep))])
+                          .append_column('fraction', pa.array(fractions[keep])))
+
+    rates = sampling_rates(populations, rate, min_samples)
+    table = pa.concat_tables(candidates)
+    country_rates = pd.Series(rates, dtype=np.float64)
+    row_rates = country_rates.reindex(table['country'].to_pandas()).fillna(0.0).to_numpy()
+    sample = table.filter(pa.array(table['fraction'].to_numpy() < row_rates)).drop_columns(['fraction'])
+
+    os.makedirs(path + ".tmp", exist_ok=True)
+    pq.write_table(sample, os.path.join(path + ".tmp", "sample.parquet"), row_group_size=1_000_000)
+    with open(os.path.join(path + ".tmp", "rates.json"), 'w') as f:
+        json.dump({'rates': rates, 'populations': populations}, f)
+    os.replace(path + ".tmp", path)
+    print(f"Sampled {sample.num_rows} of {sum(populations.values())} places, stratified over {len(rates)} "
+          f"countries, into {path} in {time.perf_counter() - start:.1f}s")
+
+
+def sample_aggregate(paths, dictionary, lookup, rate=None, min_samples=None, seed=None):
+    """
+    A DensityAccumulator over the sample of the places stratified by country
+    (drawn and stored on first use), and the sampling rate of every country.
+    """
+    path = sample_path(paths, rate, min_samples, seed)
+    if not os.path.exists(os.path.join(path, "rates.json")):
+        build_sample(paths, path, rate, min_samples, seed)
+    with open(os.path.join(path, "rates.json")) as f:
+        rates = json.load(f)['rates']
+    accumulator = DensityAccumulator(dictionary, lookup)
+    for batch in iter_place_batches(os.path.join(path, "sample.parquet")):
+        accumulator.add(batch)
+    print(f"Aggregated the sample of {accumulator.rows} places from {path}")
+    return accumulator, rates
+
+
+def with_estimates(frame, rates):
+    """
+    Scale the sampled poi_count of a frame with a country column up to the
+    population: poi_count becomes the estimate, sample_count keeps the
+    sampled count, and ci_low / ci_high bound the estimate. Every place
+    adds at most one to a count and is sampled with its country's rate p,
+    so the estimate is count / p with variance count * (1 - p) / p^2.
+    """
+    p = frame['country'].map(rates).astype(np.float64)
+    estimate = frame['poi_count'] / p
+    margin = confidence_z * np.sqrt(frame['poi_count'] * (1 - p)) / p
+    # The normal interval of a zero count is empty; a count of zero only bounds the population
+    margin = margin.where(frame['poi_count'] > 0, zero_count_bound * (1 - p) / p)
+    frame = frame.rename(columns={'poi_count': 'sample_count'})
+    frame.insert(frame.columns.get_loc('sample_count'), 'poi_count', estimate.round().astype(np.int64))
+    frame['ci_low'] = np.maximum(estimate - margin, frame['sample_count']).round().astype(np.int64)
+    frame['ci_high'] = (estimate + margin).round().astype(np.int64)
+    return frame
+
+
+def sampled_counts(paths, dictionary, lookup, rate=None, min_samples=None):
+    """Estimated country_poi_counts and category_density frames, with confidence intervals, from a sample."""
+    accumulator, rates = sample_aggregate(paths, dictionary, lookup, rate, min_samples)
+    # Every sampled country gets an estimate, also when none of its sampled places matched
+    country_counts = pd.DataFrame({'country': sorted(rates)}).merge(accumulator.country_poi_counts(),
+                                                                    on='country', how='left')
+    country_counts['poi_count'] = country_counts['poi_count'].fillna(0).astype(np.int64)
+    return with_estimates(country_counts, rates), with_estimates(accumulator.category_density(), rates)
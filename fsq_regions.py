@@ -0,0 +1,151 @@
+"""
+Aggregation over any set of regions: countries, metro areas, sales
+territories or custom polygons.
+
+A region set is a GeoJSON or GeoParquet file (or URL) with an id column and
+one or more features per region. Its boundaries go through the store of
+fsq_world.py, and its RegionIndex (fsq_spatial.py) is built once per version
+of the file and saved next to the store as
+<name>-index-<source_version>-<id_column>-....parquet, so later runs load it
+instead of building it again; within a run every theme uses the same
+RegionSet. region_counts assigns the places of every batch to the regions
+once and counts every theme of a ThemeSet per region; region_density adds
+the area-normalized density (region_areas) and Jenks classes.
+"""
+import functools
+import os
+import time
+
+import jenkspy
+import numpy as np
+import pandas as pd
+
+from fsq_aggregate import iter_place_batches, plan_shards
+from fsq_spatial import RegionIndex, grid_degrees, map_shards, max_piece_vertices
+from fsq_world import load_world, region_areas, store_name, world_dir, world_metadata
+
+# Density classes per theme
+density_classes = 5
+
+
+def index_path(source, source_version, id_column):
+    """Saved RegionIndex of a source version, with the settings it was built with in the name."""
+    return os.path.join(world_dir, f"{store_name(source)}-index-{source_version}-{id_column}-"
+                                   f"{max_piece_vertices}-{grid_degrees:g}.parquet")
+
+
+class RegionSet:
+    """
+    The regions of a boundaries source: boundaries (GeoDataFrame), the
+    RegionIndex over its features and the version of the source both are of.
+    """
+
+    def __init__(self, source, id_column='id'):
+        self.source = source
+        self.id_column = id_column
+        self.source_version = world_metadata(source)['source_version']
+        self.boundaries = load_world(source)
+        if id_column not in self.boundaries.columns:
+            raise ValueError(f"{source} has no column {id_column}, use one of {list(self.boundaries.columns)}.")
+        path = index_path(source, self.source_version, id_column)
+        if os.path.exists(path):
+            start = time.perf_counter()
+            self.index = RegionIndex.load(path)
+            print(f"Loaded the index of {len(self.index)} regions from {path} "
+                  f"in {(time.perf_counter() - start) * 1000:.0f} ms")
+        else:
+            self.index = RegionIndex(self.boundaries, id_column)
+            self.index.save(path)
+
+    def __len__(self):
+        return len(self.index)
+
+    def areas(self):
+        """DataFrame (id_column, area_km2) of the regions, see region_areas."""
+        return region_areas(self.source, self.id_column)
+
+
+@functools.lru_cache(maxsize=None)
+def _region_set(source, id_column, source_version):
+    return RegionSet(source, id_column)
+
+
+def open_region_set(source, id_column='id'):
+    """The RegionSet of a source, built or loaded once per process and version of the source."""
+    return _region_set(source, id_column, world_metadata(source)['source_version'])
+
+
+def region_shard(shard, index, theme_set, batch_rows=None):
+    """Worker: theme x feature count matrix of the places in the row groups of one shard."""
+    path, row_groups = shard
+    counts = np.zeros((len(theme_set.names), len(index)), dtype=np.int64)
+    for batch in iter_place_batches(path, columns=['fsq_category_ids', 'latitude', 'longitude'],
+                                    batch_rows=batch_rows, row_groups=row_groups):
+        offsets, codes = theme_set.dictionary.encode_lists(batch.column('fsq_category_ids'))
+        # Only places in at least one theme are assigned, once for all themes
+        row_bits = theme_set.row_bits(offsets, codes)
+        rows = np.flatnonzero(row_bits)
+        row_bits = row_bits[rows]
+        regions = index.assign(batch.column('longitude').to_numpy(zero_copy_only=False)[rows],
+                               batch.column('latitude').to_numpy(zero_copy_only=False)[rows])
+        for bit in range(len(theme_set.names)):
+            matches = ((row_bits >> np.uint64(bit)) & np.uint64(1) == 1) & (regions >= 0)
+            counts[bit] += np.bincount(regions[matches], minlength=len(index))
+    return counts
+
+
+def region_counts(paths, theme_set, region_set, max_workers=None, row_groups_per_shard=None, batch_rows=None):
+    """
+    DataFrame (theme, id_column, poi_count) of every theme and region, zero
+    counts included, from one pass over the local places files. A place
+    counts once per region it lies in; features with the same id add up.
+    """
+    start = time.perf_counter()
+    shards = plan_shards(paths, row_groups_per_shard)
+    counts = np.zeros((len(theme_set.names), len(region_set)), dtype=np.int64)
+    for partial in map_shards(region_shard, shards, region_set.index, max_workers, theme_set, batch_rows):
+        counts += partial
+    frame = pd.DataFrame({
+        'theme': np.repeat(theme_set.names, len(region_set)),
+        region_set.id_column: np.tile(region_set.index.ids, len(theme_set.names)),
+        'poi_count': counts.ravel(),
+    })
+    frame = frame.groupby(['theme', region_set.id_column], as_index=False, sort=False)['poi_count'].sum()
+    print(f"Counted {len(theme_set.names)} themes in {len(region_set)} regions of {region_set.source} "
+          f"in {time.perf_counter() - start:.1f}s")
+    return frame
+
+
+def classify_densities(values, n_classes=None):
+    """Jenks natural breaks class of every value, with equal intervals when there are too few distinct values."""
+    n_classes = n_classes or density_classes
+    values = np.asarray(values, dtype=np.float64)
+    present = values[~np.isnan(values)]
+    try:
+        if len(np.unique(present)) >= n_classes:
+            breaks = jenkspy.jenks_breaks(present, n_classes=n_classes)
+        else:
+            raise ValueError("Not enough unique values for Jenks Natural Breaks.")
+    except Exception as e:
+        print(f"Error computing Jenks Natural Breaks: {e}")
+        print("Falling back to equal intervals.")
+        breaks = np.linspace(present.min(), present.max(), num=n_classes + 1) if len(present) else []
+    print(f"Jenks breaks: {breaks}")
+    if len(np.unique(breaks)) < 2:
+        return np.where(np.isnan(values), np.nan, 0.0), breaks
+    return pd.cut(values, bins=np.unique(breaks), labels=False, include_lowest=True), breaks
+
+
+def region_density(counts, region_set, theme, n_classes=None):
+    """
+    The counts of one theme with area_km2, poi_density (per km2),
+    poi_density_scaled (per million km2) and density_class of every region.
+    Regions without an area get no density or class.
+    """
+    frame = counts[counts['theme'] == theme].drop(columns='theme')
+    frame = frame.merge(region_set.areas(), on=region_set.id_column, how='left')
+    frame['poi_density'] = frame['poi_count'] / frame['area_km2'].where(frame['area_km2'] > 0)
+    frame['poi_density_scaled'] = frame['poi_density'] * 1e6
+    classes, _ = classify_densities(frame['poi_density_scaled'], n_classes)
+    frame['density_class'] = classes
+    return frame.reset_index(drop=True)
@@ -0,0 +1,201 @@
+import io
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from fsq_download import max_connections, get_filesystem, list_parquet_parts
+
+# The only columns of the places dataset the analysis uses
+places_columns = ["fsq_category_ids", "latitude", "longitude", "country"]
+categories_columns = ["category_id", "category_name"]
+
+# Column chunk byte ranges closer than max_gap are fetched as one request,
+# as long as the merged request stays below max_block
+max_gap = 64 * 1024
+max_block = 64 * 1024 * 1024
+
+# Bytes read from the end of a file in the first request; covers most footers
+footer_sample_size = 1024 * 1024
+
+
+class SparseFile(io.RawIOBase):
+    """
+    Read-only file of a known size of which only some byte ranges are in memory.
+    Lets pyarrow parse a Parquet file from the footer and prefetched column chunks.
+    """
+
+    def __init__(self, size, ranges=None):
+        self.size = size
+        self.ranges = dict(ranges or {})  # start -> bytes
+        self.position = 0
+
+    def add(self, start, data):
+        self.ranges[start] = data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = offset
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        filled = 0
+        while self.position < end:
+            block_start, block = self.block_at(self.position)
+            take = min(end - self.position, block_start + len(block) - self.position)
+            offset = self.position - block_start
+            buffer[filled:filled + take] = block[offset:offset + take]
+            filled += take
+            self.position += take
+        return filled
+
+    def block_at(self, position):
+        for start, data in self.ranges.items():
+            if start <= position < start + len(data):
+                return start, data
+        raise IOError(f"Byte {position} was not prefetched")
+
+
+def remote_filesystem(path):
+    """Filesystem for a path: anonymous S3 for s3:// URLs, fsspec otherwise (local, http, ...)."""
+    return get_filesystem(path=path)
+
+
+def column_chunk_ranges(metadata, columns, row_groups=None):
+    """Sorted [start, end) byte ranges of the column chunks of the given top-level columns."""
+    columns = set(columns)
+    ranges = []
+    for i in row_groups if row_groups is not None else range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            chunk = row_group.column(j)
+            if chunk.path_in_schema.split('.')[0] not in columns:
+                continue
+            start = chunk.data_page_offset
+            if chunk.has_dictionary_page and 0 < chunk.dictionary_page_offset < start:
+                start = chunk.dictionary_page_offset
+            ranges.append([start, start + chunk.total_compressed_size])
+    return sorted(ranges)
+
+
+def coalesce_ranges(ranges, gap=max_gap, block=max_block):
+    """Merge sorted byte ranges separated by at most gap bytes into requests of at most block bytes."""
+    merged = []
+    for start, end in ranges:
+        if merged and start - merged[-1][1] <= gap and end - merged[-1][0] <= block:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def fetch_footer(path, fs=None, size=None):
+    """
+    Fetch the tail of a remote Parquet file and parse its footer.
+    Returns (SparseFile holding the tail, FileMetaData, bytes transferred).
+    """
+    fs = fs or remote_filesystem(path)
+    size = size or fs.size(path)
+    tail_start = max(0, size - footer_sample_size)
+    tail = fs.cat_file(path, start=tail_start, end=size)
+    if len(tail) != size - tail_start:
+        raise IOError(f"Range request for {path} returned {len(tail)} bytes; the server must support byte ranges")
+    footer_length, magic = struct.unpack("<I4s", tail[-8:])
+    if magic != b"PAR1":
+        raise ValueError(f"{path} is not a Parquet file")
+    if footer_length + 8 > len(tail):
+        tail_start = size - footer_length - 8
+        tail = fs.cat_file(path, start=tail_start, end=size)
+    sparse = SparseFile(size, {tail_start: tail})
+    return sparse, pq.ParquetFile(sparse).metadata, len(tail)
+
+
+def open_remote_parquet(path, columns, fs=None, row_groups=None, size=None, footer=None):
+    """
+    Fetch the footer (unless a footer from fetch_footer is passed) and the
+    coalesced column chunks of the given columns of one remote Parquet file.
+    Returns (ParquetFile, bytes transferred, file size).
+    """
+    fs = fs or remote_filesystem(path)
+    if footer is None:
+        footer = fetch_footer(path, fs, size)
+        transferred = footer[2]
+    else:
+        transferred = 0
+    tail, metadata, _ = footer
+    tail_start = next(iter(tail.ranges))
+    sparse = SparseFile(tail.size, tail.ranges)
+
+    requests = coalesce_ranges(column_chunk_ranges(metadata, columns, row_groups))
+    requests = [[start, end] for start, end in requests if start < tail_start]  # Already in the tail
+    if requests:
+        starts = [start for start, _ in requests]
+        ends = [end for _, end in requests]
+        for start, data in zip(starts, fs.cat_ranges([path] * len(requests), starts, ends)):
+            sparse.add(start, data)
+            transferred += len(data)
+    return pq.ParquetFile(sparse, metadata=metadata), transferred, sparse.size
+
+
+def read_remote_parquet(path, columns, fs=None, row_groups=None, size=None, footer=None):
+    """Read only the given columns of one remote Parquet file. Returns (table, bytes transferred, file size)."""
+    parquet_file, transferred, size = open_remote_parquet(path, columns, fs, row_groups, size, footer)
+    if row_groups is None:
+        table = parquet_file.read(columns=columns)
+    else:
+        table = parquet_file.read_row_groups(row_groups, columns=columns)
+    return table, transferred, size
+
+
+def remote_row_groups(dir_path, fs=None, max_workers=max_connections):
+    """
+    List every row group of every Parquet part in a remote directory as
+    (path, row group index, footer) tuples, fetching each footer once.
+    """
+    fs = fs or remote_filesystem(dir_path)
+    parts = list_parquet_parts(dir_path, fs)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        footers = list(pool.map(lambda part: fetch_footer(part['name'], fs, part.get('size')), parts))
+    return [
+        (part['name'], i, footer)
+        for part, footer in zip(parts, footers)
+        for i in range(footer[1].num_row_groups)
+    ]
+
+
+def read_remote_dataset(dir_path, columns, fs=None, max_workers=max_connections):
+    """
+    Read the given columns of every Parquet part in a remote directory (S3
+    prefix, HTTP directory listing or local path) without downloading the
+    unused columns. Returns a single pyarrow Table.
+    """
+    fs = fs or remote_filesystem(dir_path)
+    parts = list_parquet_parts(dir_path, fs)
+    print(f"Reading columns {columns} of {len(parts)} parts from {dir_path}...")
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(
+            lambda part: read_remote_parquet(part['name'], columns, fs, size=part.get('size')), parts
+        ))
+    tables = [table for table, _, _ in results]
+    transferred = sum(t for _, t, _ in results)
+    total = sum(s for _, _, s in results)
+    elapsed = time.monotonic() - start
+    print(f"Fetched {transferred / 1e6:.1f} MB of {total / 1e6:.1f} MB "
+          f"({100 * transferred / max(total, 1):.0f}%) in {elapsed:.1f}s")
+    return pa.concat_tables(tables)
@@ -0,0 +1,341 @@
+"""
+Point-in-polygon assignment of places to the regions of a boundaries source.
+
+RegionIndex splits every region polygon into pieces of at most
+max_piece_vertices vertices, prepares them and puts them in a shapely
+STRtree. When it is built, every cell of a grid_degrees grid is classified
+once with the tree: outside every region, inside a single region, or on a
+border. Points in the first two kinds of cell are assigned with numpy
+indexing alone. The points in border cells are assigned in batches: one bulk
+tree.query per batch narrows every point down to the few pieces whose box
+holds it, and shapely.intersects tests it against those small prepared
+pieces. A point on the border of two regions goes to the first of them in
+the source.
+
+spatial_aggregate runs this on the filtered places of every batch and either
+only verifies the country column against the assigned country, fills in
+missing countries, or replaces the country column, with a CountryCheck
+report of how often the two disagree.
+"""
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+import fsq_aggregate
+from fsq_aggregate import DensityAccumulator, iter_place_batches, plan_shards, process_context
+from fsq_categories import has_any_category
+from fsq_countries import country_attribute
+from fsq_world import load_world, world_geojson
+
+# Region polygons are split until every piece has at most this many vertices
+max_piece_vertices = 256
+
+# Cell size of the grid that lets points far from any border skip the exact test
+grid_degrees = 0.5
+
+# Points per bulk STRtree query
+assign_batch_size = 1_000_000
+
+# verify: only report, fill: assign places without a country, replace: the assigned country wins
+country_modes = ("verify", "fill", "replace")
+
+
+def subdivide(geometry, max_vertices=None):
+    """Pieces of a (multi)polygon, split in half along the longer side of the box until they are small enough."""
+    max_vertices = max_vertices or max_piece_vertices
+    if geometry is None or geometry.is_empty:
+        return []
+    if shapely.get_num_coordinates(geometry) <= max_vertices:
+        return [geometry]
+    if isinstance(geometry, shapely.MultiPolygon):
+        return [piece for part in geometry.geoms for piece in subdivide(part, max_vertices)]
+    xmin, ymin, xmax, ymax = geometry.bounds
+    if xmax - xmin >= ymax - ymin:
+        middle = (xmin + xmax) / 2
+        halves = [(xmin, ymin, middle, ymax), (middle, ymin, xmax, ymax)]
+    else:
+        middle = (ymin + ymax) / 2
+        halves = [(xmin, ymin, xmax, middle), (xmin, middle, xmax, ymax)]
+    pieces = []
+    for box in halves:
+        half = shapely.clip_by_rect(geometry, *box)
+        # Clipping can leave slivers of lines and points, only the polygons count
+        parts = shapely.get_parts(half)
+        pieces.extend(piece for part in parts if shapely.get_type_id(part) in (3, 6)
+                      for piece in subdivide(part, max_vertices))
+    return pieces
+
+
+class RegionIndex:
+    """
+    STRtree over the prepared, subdivided polygons of a GeoDataFrame of
+    regions, with a grid of precomputed cells. ids holds the id_column value
+    of every region, owners the region number of every piece in the tree and
+    grid the region number of every cell (-1: no region, -2: border).
+    """
+
+    def __init__(self, boundaries, id_column='id', max_vertices=None, cell_degrees=None):
+        start = time.perf_counter()
+        self.ids = boundaries[id_column].to_numpy(dtype=object)
+        self.regions = boundaries.geometry.to_numpy()
+        pieces = [subdivide(geometry, max_vertices) for geometry in self.regions]
+        self.owners = np.repeat(np.arange(len(pieces), dtype=np.int32), [len(parts) for parts in pieces])
+        self.set_pieces(np.array([piece for parts in pieces for piece in parts], dtype=object))
+        self.cell_degrees = cell_degrees or grid_degrees
+        self.grid = self.classify_cells()
+        print(f"Indexed {len(self.ids)} regions as {len(self.pieces)} pieces, "
+              f"{np.mean(self.grid == -2):.1%} of the grid cells on a border, in {time.perf_counter() - start:.1f}s")
+
+    def set_pieces(self, pieces):
+        self.pieces = pieces
+        shapely.prepare(self.pieces)
+        self.tree = shapely.STRtree(self.pieces)
+
+    def save(self, path):
+        """
+        Write the pieces with their region numbers to path (Parquet, with the
+        ids and cell size in the schema metadata) and the grid next to it, so
+        the index is loaded instead of subdivided and classified again.
+        """
+        table = pa.table({'owner': self.owners, 'geometry': shapely.to_wkb(self.pieces)})
+        table = table.replace_schema_metadata({'ids': json.dumps(self.ids.tolist(), default=lambda value: value.item()),
+                                               'cell_degrees': str(self.cell_degrees)})
+        pq.write_table(table, path + ".tmp")
+        np.save(path[:-len(".parquet")] + "-grid.npy", self.grid)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        """A RegionIndex written by save; only the STRtree is rebuilt."""
+        table = pq.read_table(path)
+        metadata = table.schema.metadata
+        index = cls.__new__(cls)
+        index.ids = np.array(json.loads(metadata[b'ids']), dtype=object)
+        index.regions = None
+        index.owners = table.column('owner').to_numpy()
+        index.set_pieces(shapely.from_wkb(table.column('geometry').to_numpy(zero_copy_only=False)))
+        index.cell_degrees = float(metadata[b'cell_degrees'])
+        index.grid = np.load(path[:-len(".parquet")] + "-grid.npy")
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def grid_shape(self):
+        return int(round(180 / self.cell_degrees)), int(round(360 / self.cell_degrees))
+
+    def classify_cells(self):
+        """Region number of every grid cell that lies inside one region, -1 outside every region, -2 otherwise."""
+        rows, columns = self.grid_shape()
+        south, west = np.meshgrid(-90 + self.cell_degrees * np.arange(rows), -180 + self.cell_degrees * np.arange(columns),
+                                  indexing='ij')
+        cells = shapely.box(west, south, west + self.cell_degrees, south + self.cell_degrees).ravel()
+        grid = np.full(len(cells), -1, dtype=np.int32)
+        cell_rows, pieces = self.tree.query(cells)
+        if not len(cell_rows):
+            return grid
+        grid[cell_rows] = -2
+        # A cell is settled when the lowest region whose pieces reach it covers it entirely,
+        # the region the exact test would pick for every point in it
+        owners = self.owners[pieces]
+        order = np.lexsort((owners, cell_rows))
+        cell_rows, owners = cell_rows[order], owners[order]
+        first = np.ones(len(cell_rows), dtype=bool)
+        first[1:] = cell_rows[1:] != cell_rows[:-1]
+        cell_rows, owners = cell_rows[first], owners[first]
+        shapely.prepare(self.regions)
+        covered = shapely.covers(self.regions[owners], cells[cell_rows])
+        grid[cell_rows[covered]] = owners[covered]
+        return grid
+
+    def cells(self, longitude, latitude):
+        """Grid cell of every point, -1 for points without (valid) coordinates."""
+        rows, columns = self.grid_shape()
+        with np.errstate(invalid='ignore'):
+            row = np.floor((latitude + 90) / self.cell_degrees)
+            column = np.floor((longitude + 180) / self.cell_degrees)
+            valid = (row >= 0) & (row <= rows) & (column >= 0) & (column <= columns)
+        # 90 and 180 themselves belong to the last row and column
+        row = np.minimum(np.where(valid, row, 0), rows - 1).astype(np.int64)
+        column = np.minimum(np.where(valid, column, 0), columns - 1).astype(np.int64)
+        return np.where(valid, row * columns + column, -1)
+
+    def assign(self, longitude, latitude, batch_rows=None):
+        """Region number of every point, -1 for points outside every region and without coordinates."""
+        longitude = np.asarray(longitude, dtype=np.float64)
+        latitude = np.asarray(latitude, dtype=np.float64)
+        batch_rows = batch_rows or assign_batch_size
+        regions = np.append(self.grid, -1)[self.cells(longitude, latitude)]
+        border = np.flatnonzero(regions == -2)
+        regions[border] = -1
+        for start in range(0, len(border), batch_rows):
+            rows = border[start:start + batch_rows]
+            points = shapely.points(longitude[rows], latitude[rows])
+            point_rows, pieces = self.tree.query(points)
+            hits = shapely.intersects(self.pieces[pieces], points[point_rows])
+            point_rows, owners = point_rows[hits], self.owners[pieces[hits]]
+            # The lowest region number per point, when it is on a border
+            order = np.lexsort((owners, point_rows))
+            point_rows, owners = point_rows[order], owners[order]
+            first = np.ones(len(point_rows), dtype=bool)
+            first[1:] = point_rows[1:] != point_rows[:-1]
+            regions[rows[point_rows[first]]] = owners[first]
+        return regions
+
+    def region_ids(self, regions):
+        """The id of every region number, None for -1."""
+        return np.append(self.ids, None)[regions]
+
+
+def country_index(source=None, max_vertices=None, cell_degrees=None):
+    """RegionIndex of a world boundaries source keyed by alpha-2 country code, like the country column."""
+    world = load_world(source or world_geojson)
+    world['alpha_2'] = country_attribute(world['id'], 'alpha_2', key='alpha_3')
+    return RegionIndex(world, 'alpha_2', max_vertices, cell_degrees)
+
+
+class CountryCheck:
+    """
+    Counts of (country column, assigned country) pairs over the checked
+    places, summarized as agree, disagree, filled (no country, assigned one),
+    unassigned (a country, but outside every region) and missing (neither).
+    """
+
+    outcomes = ['agree', 'disagree', 'filled', 'unassigned', 'missing']
+
+    def __init__(self):
+        self.pairs = pd.Series(dtype=np.int64)
+
+    def add(self, countries, assigned):
+        pairs = pd.DataFrame({'country': countries, 'assigned': assigned}).value_counts(dropna=False)
+        self.pairs = pairs.add(self.pairs, fill_value=0).astype(np.int64) if len(self.pairs) else pairs
+        return self
+
+    def merge(self, other):
+        if len(other.pairs):
+            self.pairs = other.pairs.add(self.pairs, fill_value=0).astype(np.int64) if len(self.pairs) else other.pairs
+        return self
+
+    def table(self):
+        """DataFrame (country, assigned, places, outcome), the largest pairs first."""
+        table = self.pairs.rename('places').reset_index()
+        country, assigned = table['country'].isna(), table['assigned'].isna()
+        table['outcome'] = np.select(
+            [country & assigned, country, assigned, table['country'] == table['assigned']],
+            ['missing', 'filled', 'unassigned', 'agree'], 'disagree')
+        return table.sort_values('places', ascending=False, ignore_index=True)
+
+    def summary(self):
+        """Places per outcome."""
+        table = self.table()
+        return table.groupby('outcome')['places'].sum().reindex(self.outcomes, fill_value=0)
+
+    def report(self, top=10):
+        """Print the outcomes, the disagreement rate and the most common disagreeing pairs."""
+        summary = self.summary()
+        located = summary['agree'] + summary['disagree']
+        print(f"Country column vs point-in-polygon country:\n{summary.to_string()}")
+        print(f"Disagreement rate: {summary['disagree'] / max(located, 1):.3%} of {located} places with both")
+        table = self.table()
+        disagreeing = table[table['outcome'] == 'disagree'].head(top)
+        if not disagreeing.empty:
+            print(f"Most common disagreements:\n{disagreeing[['country', 'assigned', 'places']].to_string(index=False)}")
+        return summary
+
+
+def assign_countries(batch, index, mode="verify", check=None):
+    """
+    The batch with its country column verified, filled or replaced by the
+    country of its coordinates, per mode. Pairs are counted into check.
+    """
+    if mode not in country_modes:
+        raise ValueError(f"Unknown country mode {mode}, use one of {country_modes}.")
+    countries = batch.column('country').to_numpy(zero_copy_only=False)
+    assigned = index.region_ids(index.assign(batch.column('longitude').to_numpy(zero_copy_only=False),
+                                             batch.column('latitude').to_numpy(zero_copy_only=False)))
+    if check is not None:
+        check.add(countries, assigned)
+    if mode == "verify":
+        return batch
+    if mode == "fill":
+        assigned = np.where(pd.isna(countries), assigned, countries)
+    else:
+        assigned = np.where(pd.isna(assigned), countries, assigned)
+    position = batch.schema.get_field_index('country')
+    return batch.set_column(position, 'country', pa.array(assigned, type=pa.string()))
+
+
+def spatial_shard(shard, index, dictionary, lookup, mode="verify", batch_rows=None):
+    """
+    A DensityAccumulator and CountryCheck over the row groups of one shard.
+    Only the places with a category in the lookup table are assigned.
+    """
+    path, row_groups = shard
+    accumulator = DensityAccumulator(dictionary, lookup)
+    check = CountryCheck()
+    for batch in iter_place_batches(path, batch_rows=batch_rows, row_groups=row_groups):
+        offsets, codes = dictionary.encode_lists(batch.column('fsq_category_ids'))
+        filtered = batch.filter(pa.array(has_any_category(offsets, codes, lookup)))
+        accumulator.add(assign_countries(filtered, index, mode, check))
+        # rows counts every place read, like the other aggregations, not only the filtered ones
+        accumulator.rows += batch.num_rows - filtered.num_rows
+    return accumulator, check
+
+
+_worker_index = None
+
+
+def set_worker_index(index):
+    """Process pool initializer: the index is handed over once per worker, not once per shard."""
+    global _worker_index
+    _worker_index = index
+
+
+def call_with_worker_index(function, shard, *args):
+    return function(shard, _worker_index, *args)
+
+
+def map_shards(function, shards, index, max_workers=None, *args):
+    """
+    function(shard, index, *args) of every shard, in shard order, over a
+    process pool that receives the index once per worker process, at most
+    max_processes (fsq_aggregate.py) workers unless max_workers is given.
+    """
+    max_workers = max_workers or fsq_aggregate.max_processes or os.cpu_count()
+    if max_workers == 1:
+        yield from (function(shard, index, *args) for shard in shards)
+        return
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=process_context(),
+                             initializer=set_worker_index, initargs=(index,)) as executor:
+        yield from executor.map(call_with_worker_index, [function] * len(shards), shards,
+                                *[[arg] * len(shards) for arg in args])
+
+
+def spatial_aggregate(paths, dictionary, lookup, index, mode="verify", max_workers=None, row_groups_per_shard=None,
+                      batch_rows=None):
+    """
+    parallel_aggregate with point-in-polygon countries: returns the
+    DensityAccumulator (counted by the country column after mode) and the
+    CountryCheck of the filtered places.
+    """
+    max_workers = max_workers or fsq_aggregate.max_processes or os.cpu_count()
+    shards = plan_shards(paths, row_groups_per_shard)
+    start = time.perf_counter()
+    accumulator = DensityAccumulator(dictionary, lookup)
+    check = CountryCheck()
+    for partial, partial_check in map_shards(spatial_shard, shards, index, max_workers,
+                                             dictionary, lookup, mode, batch_rows):
+        accumulator.merge(partial)
+        check.merge(partial_check)
+    elapsed = time.perf_counter() - start
+    checked = int(check.pairs.sum())
+    print(f"Assigned countries ({mode}) to {checked} of {accumulator.rows} places with {max_workers} processes "
+          f"in {elapsed:.1f}s ({accumulator.rows / max(elapsed, 1e-9) / 1e6:.1f}M rows/s)")
+    return accumulator, check
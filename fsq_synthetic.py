@@ -0,0 +1,314 @@
+"""
+Generate a synthetic Foursquare-like release for offline tests and benchmarks.
+
+Writes <out_dir>/dt=<release>/places/parquet/*.parquet and
+<out_dir>/dt=<release>/categories/parquet/categories.zstd.parquet with the same
+layout and columns the scripts use from the real release. Point the scripts at
+it with FSQ_RELEASE_ROOT=<out_dir>.
+
+    python3 fsq_synthetic.py --rows 1e6 --out synthetic
+    python3 fsq_synthetic.py --previous 2024-11-19 --release 2024-12-03 --churn 0.01 --out synthetic
+    python3 fsq_synthetic.py --world synthetic/countries.geo.json
+"""
+import argparse
+import itertools
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Rows per row group and per part file, like the real release (many row groups per part)
+row_group_rows = 1_000_000
+part_rows = 10_000_000
+
+# Approximate centre and spread (degrees) of places per country; the order sets
+# the popularity rank, so places are skewed towards the first countries
+countries = [
+    ("US", 39.8, -98.6, 8.0), ("BR", -14.2, -51.9, 7.0), ("ID", -2.5, 118.0, 6.0),
+    ("TR", 39.0, 35.2, 3.0), ("RU", 61.5, 105.3, 12.0), ("JP", 36.2, 138.3, 3.0),
+    ("MX", 23.6, -102.6, 5.0), ("GB", 54.0, -2.5, 2.0), ("DE", 51.2, 10.4, 2.0),
+    ("FR", 46.2, 2.2, 2.5), ("TH", 15.9, 101.0, 3.0), ("PH", 12.9, 121.8, 3.0),
+    ("IN", 20.6, 79.0, 6.0), ("MY", 4.2, 102.0, 2.0), ("IT", 41.9, 12.6, 2.5),
+    ("ES", 40.5, -3.7, 2.5), ("CA", 56.1, -106.3, 10.0), ("KR", 35.9, 127.8, 1.5),
+    ("AU", -25.3, 133.8, 8.0), ("AR", -38.4, -63.6, 6.0), ("NL", 52.1, 5.3, 0.7),
+    ("CL", -35.7, -71.5, 5.0), ("CO", 4.6, -74.3, 3.0), ("PL", 51.9, 19.1, 2.0),
+    ("BE", 50.5, 4.5, 0.6), ("SE", 60.1, 18.6, 4.0), ("CH", 46.8, 8.2, 0.8),
+    ("AT", 47.5, 14.6, 1.2), ("PT", 39.4, -8.2, 1.5), ("IE", 53.4, -8.2, 1.0),
+    ("CZ", 49.8, 15.5, 1.2), ("DK", 56.3, 9.5, 1.0), ("NO", 60.5, 8.5, 4.0),
+    ("FI", 61.9, 25.7, 3.0), ("NZ", -40.9, 174.9, 3.0), ("ZA", -30.6, 22.9, 4.0),
+    ("EG", 26.8, 30.8, 3.0), ("NG", 9.1, 8.7, 3.0), ("KE", -0.02, 37.9, 2.0),
+    ("FJ", -17.7, 178.1, 1.0),  # Straddles the antimeridian
+]
+
+# Category names that every release has; the rest are generated
+named_categories = [
+    "Beer Bar", "Beer Garden", "Beer Store", "Brewery", "Bar", "Pub", "Wine Bar",
+    "Winery", "Wine Shop", "Cocktail Bar", "Coffee Shop", "Café", "Restaurant",
+    "Pizzeria", "Bakery", "Supermarket", "Hotel", "Park", "Gym", "Bank",
+]
+category_count = 1200
+
+
+def place_ids(seed, start, count):
+    """Stable 32 hex character place ids derived from (seed, row number)."""
+    index = np.arange(start, start + count, dtype=np.uint64)
+    words = [splitmix64(index * np.uint64(2) + np.uint64(k) + np.uint64(seed) * np.uint64(0x9E3779B9))
+             for k in range(2)]
+    raw = np.stack(words, axis=1).astype('>u8').view(np.uint8).reshape(count, 16)
+    hex_digits = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+    chars = np.empty((count, 32), dtype=np.uint8)
+    chars[:, 0::2] = hex_digits[raw >> 4]
+    chars[:, 1::2] = hex_digits[raw & 15]
+    return pa.array(chars.view('S32').ravel()).cast(pa.string())
+
+
+def splitmix64(x):
+    """Vectorized splitmix64 hash of a uint64 array."""
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def zipf_weights(n, exponent):
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def make_categories(seed):
+    """Categories table with 24 hex character ids, including beer, wine, coffee and cocktail categories."""
+    rng = np.random.default_rng(seed)
+    words = rng.integers(0, 2 ** 32, size=(category_count, 3), dtype=np.uint64)
+    ids = [f"{a:08x}{b:08x}{c:08x}" for a, b, c in words]
+    names = named_categories + [f"Category {i}" for i in range(len(named_categories), category_count)]
+    levels = np.where(np.arange(category_count) < len(named_categories), 3, rng.integers(1, 7, category_count))
+    table = pa.table({
+        'category_id': pa.array(ids, pa.string()),
+        'category_level': pa.array(levels, pa.int32()),
+        'category_name': pa.array(names, pa.string()),
+        'category_label': pa.array([f"Dining and Drinking > {name}" for name in names], pa.string()),
+    })
+    # Row order sets the popularity rank in make_places, so shuffle the named categories in
+    return table.take(rng.permutation(category_count))
+
+
+def make_places(rng, seed, start, count, categories):
+    """One batch of places with the columns of the real places dataset."""
+    country_codes = rng.choice(len(countries), size=count, p=zipf_weights(len(countries), 1.1))
+    _, lat_centre, lon_centre, spread = (np.array(column) for column in zip(*countries))
+    latitude = np.clip(lat_centre[country_codes] + rng.normal(0, 1, count) * spread[country_codes] / 2, -90, 90)
+    longitude = lon_centre[country_codes] + rng.normal(0, 1, count) * spread[country_codes]
+    longitude = (longitude + 180) % 360 - 180
+
+    # 0 to 3 categories per place, popular categories much more common
+    per_place = rng.choice(4, size=count, p=[0.05, 0.7, 0.18, 0.07])
+    offsets = np.zeros(count + 1, dtype=np.int32)
+    np.cumsum(per_place, out=offsets[1:])
+    codes = rng.choice(categories.num_rows, size=int(offsets[-1]), p=zipf_weights(categories.num_rows, 0.9))
+    codes = pa.array(codes.astype(np.int32))
+    category_ids = pa.DictionaryArray.from_arrays(codes, categories['category_id'].combine_chunks())
+    category_labels = pa.DictionaryArray.from_arrays(codes, categories['category_label'].combine_chunks())
+
+    index = pa.array(np.arange(start, start + count))
+    country_names = pa.array([code for code, *_ in countries], pa.string())
+    created = pa.array(rng.integers(12000, 20000, count).astype(np.int32), pa.date32())
+    return pa.table({
+        'fsq_place_id': place_ids(seed, start, count),
+        'name': pc.binary_join_element_wise("Place ", index.cast(pa.string()), ""),
+        'latitude': pa.array(latitude),
+        'longitude': pa.array(longitude),
+        'address': pc.binary_join_element_wise(index.cast(pa.string()), " Main Street", ""),
+        'country': pa.DictionaryArray.from_arrays(pa.array(country_codes.astype(np.int32)), country_names)
+                     .dictionary_decode(),
+        'date_created': created.cast(pa.string()),
+        'date_refreshed': created.cast(pa.string()),
+        'date_closed': pa.nulls(count, pa.string()),
+        'fsq_category_ids': pa.ListArray.from_arrays(pa.array(offsets), category_ids.dictionary_decode()),
+        'fsq_category_labels': pa.ListArray.from_arrays(pa.array(offsets), category_labels.dictionary_decode()),
+    })
+
+
+def generate_release(out_dir, rows, seed=42, release_date="2024-11-19", row_group_size=None):
+    """Write a seeded synthetic release of the given number of places into out_dir."""
+    rows = int(rows)
+    row_group_size = row_group_size or row_group_rows
+    release_dir = os.path.join(out_dir, f"dt={release_date}")
+    places_dir = os.path.join(release_dir, "places", "parquet")
+    categories_dir = os.path.join(release_dir, "categories", "parquet")
+    os.makedirs(places_dir, exist_ok=True)
+    os.makedirs(categories_dir, exist_ok=True)
+
+    categories = make_categories(seed)
+    pq.write_table(categories, os.path.join(categories_dir, "categories.zstd.parquet"), compression="zstd")
+
+    rng = np.random.default_rng(seed)
+    part = 0
+    for part_start in range(0, rows, part_rows):
+        part_path = os.path.join(places_dir, f"places-{part:05d}.zstd.parquet")
+        writer = None
+        for start in range(part_start, min(part_start + part_rows, rows), row_group_size):
+            count = min(row_group_size, rows - start, part_start + part_rows - start)
+            table = make_places(rng, seed, start, count, categories)
+            if writer is None:
+                writer = pq.ParquetWriter(part_path, table.schema, compression="zstd")
+            writer.write_table(table, row_group_size=count)
+        writer.close()
+        print(f"Wrote {part_path}")
+        part += 1
+    print(f"Synthetic release dt={release_date} with {rows} places written to {out_dir}")
+    return release_dir
+
+
+def generate_world(path):
+    """
+    Write a world GeoJSON like world_geojson for the synthetic countries: the
+    Voronoi cells of their centres, with the alpha-3 code as feature id.
+    """
+    import json
+
+    import pycountry
+    import shapely
+
+    codes, latitudes, longitudes, _ = zip(*countries)
+    centres = shapely.multipoints(np.column_stack([longitudes, latitudes]))
+    world_box = shapely.box(-180, -90, 180, 90)
+    cells = shapely.get_parts(shapely.voronoi_polygons(centres, extend_to=world_box))
+    features = []
+    for code, lat, lon in zip(codes, latitudes, longitudes):
+        cell = next(cell for cell in cells if cell.contains(shapely.Point(lon, lat)))
+        country = pycountry.countries.get(alpha_2=code)
+        features.append({
+            'type': 'Feature',
+            'id': country.alpha_3,
+            'properties': {'name': country.name},
+            'geometry': shapely.geometry.mapping(cell.intersection(world_box)),
+        })
+    with open(path, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    print(f"Wrote {len(features)} synthetic country boundaries to {path}")
+    return path
+
+
+def write_places(places_dir, tables, row_group_size=None):
+    """
+    Write places tables, one after the other, as part files of part_rows rows
+    with row groups of row_group_size rows. Only the current row group is
+    buffered, so the tables can be streamed.
+    """
+    row_group_size = row_group_size or row_group_rows
+    os.makedirs(places_dir, exist_ok=True)
+    part, part_written, writer, buffer = 0, 0, None, None
+
+    def write_row_group(table):
+        nonlocal part, part_written, writer
+        if writer is None:
+            writer = pq.ParquetWriter(os.path.join(places_dir, f"places-{part:05d}.zstd.parquet"), table.schema,
+                                      compression="zstd")
+        writer.write_table(table, row_group_size=table.num_rows)
+        part_written += table.num_rows
+        if part_written == part_rows:
+            close_part()
+
+    def close_part():
+        nonlocal part, part_written, writer
+        writer.close()
+        print(f"Wrote {os.path.join(places_dir, f'places-{part:05d}.zstd.parquet')}")
+        part, part_written, writer = part + 1, 0, None
+
+    for table in tables:
+        buffer = table if buffer is None else pa.concat_tables([buffer, table])
+        while buffer.num_rows >= min(row_group_size, part_rows - part_written):
+            rows = min(row_group_size, part_rows - part_written)
+            write_row_group(buffer.slice(0, rows))
+            buffer = buffer.slice(rows)
+    if buffer is not None and buffer.num_rows:
+        write_row_group(buffer)
+    if writer is not None:
+        close_part()
+
+
+def generate_next_release(out_dir, previous_date, release_date, churn=0.01, seed=43):
+    """
+    Write release_date as a copy of the synthetic release previous_date with a
+    fraction churn of the places changed: a third deleted, a third with new
+    categories and a third newly inserted. Like in the real release, changed
+    and inserted places get date_refreshed release_date; they are written
+    after the kept places. The previous release is streamed row group by row
+    group; only the changed places are held in memory.
+    """
+    previous_dir = os.path.join(out_dir, f"dt={previous_date}")
+    release_dir = os.path.join(out_dir, f"dt={release_date}")
+    categories_dir = os.path.join(release_dir, "categories", "parquet")
+    os.makedirs(categories_dir, exist_ok=True)
+    categories = pq.read_table(os.path.join(previous_dir, "categories", "parquet"))
+    pq.write_table(categories, os.path.join(categories_dir, "categories.zstd.parquet"), compression="zstd")
+
+    previous_places = os.path.join(previous_dir, "places", "parquet")
+    paths = [os.path.join(previous_places, name) for name in sorted(os.listdir(previous_places))
+             if name.endswith(".parquet")]
+    count = sum(pq.ParquetFile(path).metadata.num_rows for path in paths)
+    rng = np.random.default_rng(seed)
+    changes = int(count * churn / 3)
+    picked = rng.choice(count, 3 * changes, replace=False)
+    deleted, changed, donors = (np.sort(rows) for rows in np.split(picked, 3))
+    changed_places, donor_places = [], []
+
+    def kept_places():
+        start = 0
+        for path in paths:
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=row_group_rows):
+                table = pa.Table.from_batches([batch])
+                end = start + table.num_rows
+                changed_places.append(table.take(changed[(changed >= start) & (changed < end)] - start))
+                donor_places.append(table.take(donors[(donors >= start) & (donors < end)] - start)
+                                    .select(['fsq_category_ids', 'fsq_category_labels']))
+                kept = np.ones(table.num_rows, dtype=bool)
+                kept[deleted[(deleted >= start) & (deleted < end)] - start] = False
+                kept[changed[(changed >= start) & (changed < end)] - start] = False
+                yield table.filter(pa.array(kept))
+                start = end
+
+    def changed_and_inserted():
+        places = pa.concat_tables(changed_places)
+        donor_categories = pa.concat_tables(donor_places)
+        for column in ['fsq_category_ids', 'fsq_category_labels']:
+            places = places.set_column(places.schema.get_field_index(column), column, donor_categories[column])
+        yield refreshed(places, ['date_refreshed'])
+        # Every release date inserts from its own range of 2**32 row numbers, far above those of
+        # generate_release, so chained releases never reuse the ids of an earlier one
+        first_index = int(np.datetime64(release_date, 'D').astype(np.int64)) << 32
+        inserted = make_places(rng, seed, first_index, changes, categories).cast(places.schema)
+        yield refreshed(inserted, ['date_created', 'date_refreshed'])
+
+    def refreshed(places, columns):
+        for column in columns:
+            places = places.set_column(places.schema.get_field_index(column), column,
+                                       pa.array([release_date] * places.num_rows, places.schema.field(column).type))
+        return places
+
+    write_places(os.path.join(release_dir, "places", "parquet"),
+                 itertools.chain(kept_places(), changed_and_inserted()))
+    print(f"Synthetic release dt={release_date} with {count} places written to {out_dir} "
+          f"({changes} deleted, {changes} changed, {changes} inserted)")
+    return release_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Foursquare-like release.")
+    parser.add_argument("--rows", type=float, default=1e6, help="number of places (1e5 to 1e8)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--release", default="2024-11-19", help="release date used in the dt= directory")
+    parser.add_argument("--out", default="synthetic", help="output directory, use as FSQ_RELEASE_ROOT")
+    parser.add_argument("--previous", help="derive the release from this earlier synthetic release instead")
+    parser.add_argument("--churn", type=float, default=0.01, help="fraction of places changed with --previous")
+    parser.add_argument("--world", help="write a world GeoJSON of the synthetic countries to this path instead")
+    args = parser.parse_args()
+    if args.world:
+        generate_world(args.world)
+    elif args.previous:
+        generate_next_release(args.out, args.previous, args.release, args.churn, args.seed)
+    else:
+        generate_release(args.out, args.rows, args.seed, args.release)
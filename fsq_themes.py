@@ -0,0 +1,85 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from fsq_aggregate import CountryIndex, count_matrix
+
+# Theme name -> regular expressions matched case-insensitively against category_name
+themes = {
+    "beer": ["beer"],
+    "wine": ["wine"],
+    "coffee": ["coffee", r"caf[eé]"],
+    "cocktail": ["cocktail"],
+}
+
+
+class ThemeSet:
+    """
+    A set of themes compiled once against a CategoryDictionary. Every category
+    code gets a bitmask of the themes it belongs to (up to 64 themes), so one
+    pass over the places tells for every theme which places and categories match.
+    """
+
+    def __init__(self, dictionary, theme_patterns=None):
+        theme_patterns = theme_patterns or themes
+        if len(theme_patterns) > 64:
+            raise ValueError("At most 64 themes can be computed in one pass.")
+        self.dictionary = dictionary
+        self.names = list(theme_patterns)
+        category_names = dictionary.names.to_pandas()
+        # One extra entry for code -1 (unknown category id), which matches no theme
+        self.bits = np.zeros(len(dictionary) + 1, dtype=np.uint64)
+        for bit, name in enumerate(self.names):
+            pattern = "|".join(f"(?:{p})" for p in theme_patterns[name])
+            matches = category_names.str.contains(pattern, flags=re.IGNORECASE, regex=True, na=False)
+            self.bits[:-1][matches.to_numpy()] |= np.uint64(1) << np.uint64(bit)
+            print(f"Theme '{name}': {int(matches.sum())} categories")
+
+    def theme_codes(self, name):
+        """Category codes belonging to a theme."""
+        bit = np.uint64(1) << np.uint64(self.names.index(name))
+        return np.flatnonzero(self.bits[:-1] & bit)
+
+    def row_bits(self, offsets, codes):
+        """Per place, the bitmask of the themes any of its categories belongs to."""
+        result = np.zeros(len(offsets) - 1, dtype=np.uint64)
+        non_empty = np.diff(offsets) > 0
+        if non_empty.any():
+            # reduceat over the starts of the non-empty rows only: empty rows hold no codes
+            result[non_empty] = np.bitwise_or.reduceat(self.bits[codes], offsets[:-1][non_empty])
+        return result
+
+    def count(self, table):
+        """
+        Count the places of an Arrow table with fsq_category_ids and country for
+        every theme in one scan. Returns two DataFrames:
+        (theme, country, poi_count) and (theme, country, category_name, poi_count).
+        """
+        offsets, codes = self.dictionary.encode_lists(table['fsq_category_ids'])
+        countries = CountryIndex()
+        country_codes = countries.encode(table['country'])
+        country_names = np.array(countries.names, dtype=object)
+        row_bits = self.row_bits(offsets, codes)
+
+        country_counts = []
+        for bit, name in enumerate(self.names):
+            matches = ((row_bits >> np.uint64(bit)) & np.uint64(1) == 1) & (country_codes >= 0)
+            counts = np.bincount(country_codes[matches], minlength=len(countries))
+            present = np.flatnonzero(counts)
+            country_counts.append(pd.DataFrame({'theme': name, 'country': country_names[present],
+                                                'poi_count': counts[present]}))
+
+        # Every (place, category) pair whose category is in at least one theme, in one count matrix
+        matrix = count_matrix(country_codes, offsets, codes, self.bits != 0, len(countries))
+        category_counts = []
+        for name in self.names:
+            theme_codes = self.theme_codes(name)
+            country_index, column = np.nonzero(matrix[:, theme_codes])
+            category_counts.append(pd.DataFrame({
+                'theme': name,
+                'country': country_names[country_index],
+                'category_name': self.dictionary.category_names(theme_codes[column]),
+                'poi_count': matrix[country_index, theme_codes[column]],
+            }))
+        return pd.concat(country_counts, ignore_index=True), pd.concat(category_counts, ignore_index=True)
@@ -0,0 +1,143 @@
+"""
+Memory-mapped Arrow IPC cache of the parsed places working set.
+
+Parquet decoding and parsing fsq_category_ids is the same on every run of a
+release, so the result is written once to
+<workset_dir>/<release root hash>/dt=<release>/ as uncompressed Arrow IPC
+files:
+
+- places.arrow: country code (int16), latitude and longitude (float32) and
+  the category codes (list<int16>, i.e. CSR offsets and codes) of every place
+  that has a country and at least one known category
+- categories.arrow: the categories the codes refer to
+- countries.json: the country names of the country codes
+
+Later runs memory-map the files, and the numpy arrays are views of the
+mapped pages: opening takes milliseconds and nothing is copied.
+"""
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from fsq_aggregate import CountryIndex, DensityAccumulator, iter_place_batches
+from fsq_categories import CategoryDictionary, parser_version
+from fsq_download import release_root_key
+from fsq_mirror import mirror_release, resolve_release
+
+workset_dir = os.path.join("fsq_cache", "workset")
+
+workset_schema = pa.schema([
+    ('country', pa.int16()),
+    ('latitude', pa.float32()),
+    ('longitude', pa.float32()),
+    ('category_codes', pa.list_(pa.int16())),
+])
+
+
+def workset_path(dt):
+    return os.path.join(workset_dir, release_root_key(), f"dt={dt}")
+
+
+def build_working_set(path, places_files, categories):
+    """Parse, filter and encode the places files batch by batch into a working set at path."""
+    start = time.perf_counter()
+    dictionary = CategoryDictionary(categories)
+    if dictionary.dtype != np.int16:
+        raise ValueError(f"{len(dictionary)} categories do not fit the int16 category codes of the working set.")
+    countries = CountryIndex()
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    rows = 0
+    with pa.OSFile(os.path.join(tmp_path, "places.arrow"), 'wb') as sink:
+        with pa.ipc.new_file(sink, workset_schema) as writer:
+            for batch in iter_place_batches(places_files):
+                offsets, codes = dictionary.encode_lists(batch.column('fsq_category_ids'))
+                country_codes = countries.encode(batch.column('country'))
+                # Drop unknown category ids (code -1) and recompute the offsets
+                known = codes >= 0
+                known_before = np.zeros(len(codes) + 1, dtype=np.int32)
+                np.cumsum(known, out=known_before[1:])
+                known_offsets = known_before[offsets]
+                keep = (country_codes >= 0) & (np.diff(known_offsets) > 0)
+                category_codes = pa.ListArray.from_arrays(pa.array(known_offsets), pa.array(codes[known]))
+                writer.write_batch(pa.record_batch([
+                    pa.array(country_codes.astype(np.int16)),
+                    pc.fill_null(batch.column('latitude').cast(pa.float32()), np.nan),
+                    pc.fill_null(batch.column('longitude').cast(pa.float32()), np.nan),
+                    category_codes,
+                ], schema=workset_schema).filter(pa.array(keep)))
+                rows += int(keep.sum())
+
+    # The country names are only known once every batch is written, so they go into a small sidecar
+    with open(os.path.join(tmp_path, "countries.json"), 'w') as f:
+        json.dump({'countries': countries.names, 'parser_version': parser_version}, f)
+    with pa.OSFile(os.path.join(tmp_path, "categories.arrow"), 'wb') as sink:
+        table = pa.table({'category_id': dictionary.ids, 'category_name': dictionary.names})
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    print(f"Built working set of {rows} places in {path} in {time.perf_counter() - start:.1f}s")
+
+
+class WorkingSet:
+    """A memory-mapped working set; its arrays are zero-copy views of the mapped file."""
+
+    def __init__(self, path):
+        start = time.perf_counter()
+        with open(os.path.join(path, "countries.json")) as f:
+            self.countries = json.load(f)['countries']
+        self.categories = pa.ipc.open_file(pa.memory_map(os.path.join(path, "categories.arrow"))).read_all()
+        self.dictionary = CategoryDictionary(self.categories)
+        self.places = pa.ipc.open_file(pa.memory_map(os.path.join(path, "places.arrow"))).read_all()
+        self.rows = self.places.num_rows
+        print(f"Opened working set of {self.rows} places ({self.places.nbytes / 1e6:.0f} MB mapped) "
+              f"in {time.perf_counter() - start:.3f}s")
+
+    def batches(self):
+        """(country_codes, latitude, longitude, offsets, codes) numpy views per record batch."""
+        for batch in self.places.to_batches():
+            category_codes = batch.column('category_codes')
+            offsets = category_codes.offsets.to_numpy()
+            yield (
+                batch.column('country').to_numpy(),
+                batch.column('latitude').to_numpy(),
+                batch.column('longitude').to_numpy(),
+                offsets - offsets[0],
+                category_codes.values.to_numpy()[offsets[0]:offsets[-1]],
+            )
+
+    def aggregate(self, lookup):
+        """DensityAccumulator of the working set for a lookup table over self.dictionary."""
+        start = time.perf_counter()
+        accumulator = DensityAccumulator(self.dictionary, lookup)
+        country_map = accumulator.countries.add(self.countries)
+        for country_codes, latitude, longitude, offsets, codes in self.batches():
+            accumulator.add_codes(country_map[country_codes], offsets, codes, latitude, longitude)
+        print(f"Aggregated {accumulator.rows} places from the working set in {time.perf_counter() - start:.2f}s")
+        return accumulator
+
+
+def open_working_set(dt):
+    """
+    The working set of release dt (None for the newest release on S3), built
+    from the local mirror the first time.
+    """
+    dt = resolve_release(dt)
+    path = workset_path(dt)
+    valid = os.path.exists(os.path.join(path, "countries.json"))
+    if valid:
+        with open(os.path.join(path, "countries.json")) as f:
+            valid = json.load(f)['parser_version'] == parser_version
+    if not valid:
+        release_parts = mirror_release(dt)
+        build_working_set(path, release_parts['places'], pq.read_table(release_parts['categories']))
+    return WorkingSet(path)
@@ -0,0 +1,165 @@
+"""
+Local GeoParquet store of the world boundaries used by the choropleths.
+
+The first use downloads the world GeoJSON once, parses it and writes it to
+<world_dir>/<name>.parquet as GeoParquet (WKB geometries, GeoParquet
+metadata and a bbox covering column) in longitude/latitude (boundary_crs),
+with a <name>.json sidecar holding the source, a hash of the source bytes
+and the store_format (source_version), the feature count and the total
+bounds. Later runs read the GeoParquet file, which takes
+milliseconds, and only once per process.
+"""
+import functools
+import hashlib
+import json
+import os
+import time
+
+import geopandas as gpd
+import pandas as pd
+
+from fsq_download import download_file
+
+# Geospatial data for country boundaries (GeoJSON), id is the alpha-3 country code
+world_geojson = "https://raw.githubusercontent.com/johan/world.geo.json/master/countries.geo.json"
+
+world_dir = os.path.join("fsq_cache", "world")
+
+# Boundaries are stored in longitude/latitude, like the coordinates of the places
+boundary_crs = "EPSG:4326"
+
+# Version of the store layout; stores (and the indexes and areas of their source_version) of other versions are rebuilt
+store_format = 2
+
+# Equal-area projection for areas (Lambert cylindrical equal area on WGS 84, valid worldwide)
+area_crs = "EPSG:6933"
+
+# Boundary edges are split into segments of at most this many degrees before projecting
+densify_degrees = 0.25
+
+
+def store_name(source):
+    """File name of a source in the store: its base name and a short hash of the full source."""
+    base = os.path.splitext(os.path.basename(source.rstrip('/')))[0].split('.')[0] or "boundaries"
+    return f"{base}-{hashlib.sha256(source.encode()).hexdigest()[:8]}"
+
+
+def store_path(source=world_geojson):
+    return os.path.join(world_dir, store_name(source) + ".parquet")
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def build_world_store(source=world_geojson):
+    """
+    Download (for URLs) and convert a boundaries file (GeoJSON, GeoParquet or
+    anything else geopandas reads) to the GeoParquet store; returns its path.
+    """
+    start = time.perf_counter()
+    os.makedirs(world_dir, exist_ok=True)
+    path = store_path(source)
+    if "://" in source:
+        local_source = os.path.join(world_dir, store_name(source) + os.path.splitext(source)[1])
+        download_file(source, local_source)
+    else:
+        local_source = source
+    if local_source.endswith((".parquet", ".geoparquet")):
+        boundaries = gpd.read_parquet(local_source)
+    else:
+        boundaries = gpd.read_file(local_source)
+    if boundaries.crs is None:
+        boundaries = boundaries.set_crs(boundary_crs)
+    elif boundaries.crs != boundary_crs:
+        print(f"Reprojecting the boundaries of {source} from {boundaries.crs.to_string()} to {boundary_crs}")
+        boundaries = boundaries.to_crs(boundary_crs)
+    boundaries.to_parquet(path + ".tmp", index=False, write_covering_bbox=True)
+    os.replace(path + ".tmp", path)
+    with open(path[:-len(".parquet")] + ".json", 'w') as f:
+        json.dump({
+            'source': source,
+            'source_version': f"{file_hash(local_source)}-{store_format}",
+            'store_format': store_format,
+            'features': len(boundaries),
+            'total_bounds': [float(value) for value in boundaries.total_bounds],
+            'crs': boundaries.crs.to_string(),
+        }, f, indent=2)
+    print(f"Stored {len(boundaries)} boundaries from {source} in {path} in {time.perf_counter() - start:.1f}s")
+    return path
+
+
+def store_ready(source):
+    """
+    Whether the store of a source exists in the current store_format and, for
+    local sources, is newer than the source file.
+    """
+    path = store_path(source)
+    if not os.path.exists(path):
+        return False
+    with open(path[:-len(".parquet")] + ".json") as f:
+        if json.load(f).get('store_format') != store_format:
+            return False
+    return "://" in source or os.path.getmtime(path) >= os.path.getmtime(source)
+
+
+def world_metadata(source=world_geojson):
+    """The sidecar of a stored source: source, source_version, features, total_bounds and crs."""
+    path = store_path(source)
+    if not store_ready(source):
+        build_world_store(source)
+    with open(path[:-len(".parquet")] + ".json") as f:
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_world(path):
+    start = time.perf_counter()
+    boundaries = gpd.read_parquet(path)
+    print(f"Loaded {len(boundaries)} boundaries from {path} in {(time.perf_counter() - start) * 1000:.0f} ms")
+    return boundaries
+
+
+def load_world(source=world_geojson):
+    """
+    The boundaries of a source as a GeoDataFrame, from the GeoParquet store
+    (built on first use). Read once per process; returns a copy, so callers
+    can merge into it freely.
+    """
+    path = store_path(source)
+    if not store_ready(source):
+        build_world_store(source)
+        _read_world.cache_clear()
+    return _read_world(path).copy()
+
+
+def areas_path(source, source_version, id_column):
+    return os.path.join(world_dir, f"{store_name(source)}-areas-{source_version}-{id_column}.parquet")
+
+
+def region_areas(source=world_geojson, id_column='id'):
+    """
+    DataFrame (id_column, area_km2) with the area of every region of a
+    boundaries source, computed in an equal-area projection. Regions with
+    several features are summed. Cached per source version and id_column, so
+    it is computed once for every version of every region set.
+    """
+    source_version = world_metadata(source)['source_version']
+    path = areas_path(source, source_version, id_column)
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+
+    start = time.perf_counter()
+    boundaries = load_world(source)
+    # Densify first, so long edges follow the same path they have on the unprojected map
+    projected = boundaries.geometry.segmentize(densify_degrees).to_crs(area_crs)
+    areas = pd.DataFrame({id_column: boundaries[id_column].to_numpy(), 'area_km2': projected.area.to_numpy() / 1e6})
+    areas = areas.groupby(id_column, as_index=False, sort=True)['area_km2'].sum()
+    areas.to_parquet(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+    print(f"Computed equal-area areas of {len(areas)} regions of {source} in {time.perf_counter() - start:.1f}s")
+    return areas